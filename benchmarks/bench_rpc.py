@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Latency and throughput of cocaine.flow.rpc.send_json_rpc fan-outs
+    against fake nodes (see fakenode.py) running in a separate process.
+
+        python benchmarks/bench_rpc.py --sizes 1,10,100,1000 --rounds 50 --latency 0.005
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+from time import time, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cocaine.flow import rpc
+import fakenode
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def raise_fd_limit():
+    # every host costs a couple of descriptors on both sides
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def run_nodes(size, options, ready, stop):
+    raise_fd_limit()
+    hosts = [fakenode.FakeHost(options.port + i, options.latency, options.jitter,
+                               options.drop_rate, options.reply_size)
+             for i in xrange(size)]
+    ready.set()
+    fakenode.serve(hosts, stop=stop)
+
+
+def bench(size, options):
+    ready = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    nodes = multiprocessing.Process(target=run_nodes, args=(size, options, ready, stop))
+    nodes.start()
+    ready.wait()
+    sleep(0.2)
+
+    hosts = ['127.0.0.1:%d' % (options.port + i) for i in xrange(size)]
+    latencies = []
+    timeouts = 0
+    try:
+        # warm up connections unless every round has to connect from scratch
+        rpc.send_json_rpc(2, [], hosts, options.timeout)
+        started = time()
+        for _ in xrange(options.rounds):
+            if options.cold:
+                rpc.pool.close()
+            call_started = time()
+            res = rpc.send_json_rpc(2, [], hosts, options.timeout)
+            latencies.append(time() - call_started)
+            timeouts += sum(1 for reply in res.itervalues() if reply is None)
+        elapsed = time() - started
+    finally:
+        rpc.pool.close()
+        stop.set()
+        nodes.join()
+
+    replies = size * options.rounds - timeouts
+    return {
+        'hosts': size,
+        'p50': percentile(latencies, 50) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'calls': options.rounds / elapsed,
+        'replies': replies / elapsed,
+        'timeouts': timeouts,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='send_json_rpc benchmark')
+    parser.add_argument('--sizes', default='1,10,100,1000', help='comma separated numbers of hosts')
+    parser.add_argument('--rounds', type=int, default=50, help='calls per size')
+    parser.add_argument('--timeout', type=float, default=0.5, help='rpc timeout, seconds')
+    parser.add_argument('--port', type=int, default=15000, help='port of the first fake host')
+    parser.add_argument('--latency', type=float, default=0.0, help='reply latency of fake hosts, seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='latency deviation, seconds')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='share of requests left unanswered')
+    parser.add_argument('--reply-size', type=int, default=0, help='padding of info replies, bytes')
+    parser.add_argument('--cold', action='store_true', help='reconnect to every host on each call')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(name)s: %(message)s')
+    raise_fd_limit()
+    print '%8s %10s %10s %10s %12s %10s' % ('hosts', 'p50, ms', 'p99, ms', 'calls/s', 'replies/s', 'timeouts')
+    for size in map(int, options.sizes.split(',')):
+        r = bench(size, options)
+        print '%(hosts)8d %(p50)10.2f %(p99)10.2f %(calls)10.1f %(replies)12.1f %(timeouts)10d' % r
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Latency and operation counts of storage backends under the same workload:
+    a catalog of N manifests of D developers and M hosts, single reads and
+    writes of the views, then K threads running deploys and uploads.
+
+    Backends are the in-memory reference storage, local sqlite storage in
+    a temporary directory and stand-ins for remote ones: Elliptics storage
+    over an in-memory session with simulated round trip latency, keeping
+    archives for nodes as by default (`elliptics`) or by deduplicated chunks
+    (`elliptics-chunked`, ELLIPTICS_NODE_ARCHIVES off), and Mongo
+    storage over mongomock (skipped when mongomock is not installed, app
+    archives are skipped as mongomock has no GridFS).
+
+    `ops/call` counts requests to the backend: session calls of Elliptics,
+    statements of sqlite, collection calls of Mongo.
+
+        python benchmarks/bench_storage.py --manifests 1000 --hosts 100 --concurrency 8 --latency 0.0005
+"""
+import argparse
+from cStringIO import StringIO
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+from time import time, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cocaine', 'flow'))
+
+from cocaine.flow.storages.cache import ReadCache
+from cocaine.flow.storages.local import Local
+from cocaine.flow.storages.memory import Memory, MemorySession
+from cocaine.flow.storages.storage import DEFAULT_COMPRESS_THRESHOLD
+
+
+BACKENDS = ('memory', 'local', 'elliptics', 'elliptics-chunked', 'mongo')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+class OpCounter(object):
+    """
+        Requests to the backend made by the current thread
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def add(self):
+        self.local.ops = self.ops + 1
+
+    @property
+    def ops(self):
+        return getattr(self.local, 'ops', 0)
+
+
+class Counting(object):
+    """
+        Proxy counting calls of `target` methods
+    """
+
+    def __init__(self, target, counter):
+        self.target = target
+        self.counter = counter
+
+    def __getattr__(self, name):
+        attr = getattr(self.target, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self.counter.add()
+            return attr(*args, **kwargs)
+
+        return call
+
+    def __enter__(self):
+        self.target.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.target.__exit__(*exc_info)
+
+
+class RemoteSession(MemorySession):
+    """
+        In-memory session paying `latency` per request like a remote one
+    """
+
+    def __init__(self, latency):
+        super(RemoteSession, self).__init__()
+        self.latency = latency
+
+    def read(self, key):
+        sleep(self.latency)
+        return super(RemoteSession, self).read(key)
+
+    def read_data(self, key, *args, **kwargs):
+        sleep(self.latency)
+        return super(RemoteSession, self).read_data(key, *args, **kwargs)
+
+    def bulk_read(self, keys):
+        sleep(self.latency)
+        return super(RemoteSession, self).bulk_read(keys)
+
+    def write(self, key, data, *args, **kwargs):
+        sleep(self.latency)
+        return super(RemoteSession, self).write(key, data)
+
+    def write_data(self, key, data, *args, **kwargs):
+        sleep(self.latency)
+        return super(RemoteSession, self).write_data(key, data, *args, **kwargs)
+
+    def remove(self, key, *args, **kwargs):
+        sleep(self.latency)
+        return super(RemoteSession, self).remove(key)
+
+
+class CountingLocal(Local):
+    counter = OpCounter()
+
+    @property
+    def db(self):
+        return Counting(Local.db.fget(self), self.counter)
+
+
+class MongomockCollection(Counting):
+    """
+        mongomock speaks pymongo 3, Mongo storage is written for pymongo 2
+    """
+
+    def __getattr__(self, name):
+        method = super(MongomockCollection, self).__getattr__(name)
+        if not callable(method):
+            return method
+
+        def call(*args, **kwargs):
+            if 'fields' in kwargs:
+                kwargs['projection'] = kwargs.pop('fields')
+            kwargs.pop('safe', None)
+            return method(*args, **kwargs)
+
+        return call
+
+
+class MongomockDatabase(object):
+    def __init__(self, db, counter):
+        self.db = db
+        self.counter = counter
+
+    def __getitem__(self, name):
+        return MongomockCollection(self.db[name], self.counter)
+
+    __getattr__ = __getitem__
+
+
+def create_backend(name, options, path):
+    """
+        Returns (storage, counter, whether app archives are supported) or None
+    """
+    counter = OpCounter()
+    if name == 'memory':
+        return Memory(options.chunk_size, Counting(MemorySession(), counter)), counter, True
+    elif name in ('elliptics', 'elliptics-chunked'):
+        session = Counting(RemoteSession(options.latency), counter)
+        return Memory(options.chunk_size, session, node_archives=name == 'elliptics'), counter, True
+    elif name == 'local':
+        storage = CountingLocal(path, options.chunk_size)
+        storage.counter = counter
+        return storage, counter, True
+    elif name == 'mongo':
+        try:
+            import mongomock
+            from cocaine.flow.storages.mongo import Mongo, INDEXES
+        except ImportError as e:
+            print 'mongo is skipped: %s' % e
+            return None
+        storage = Mongo.__new__(Mongo)
+        storage.mongo = type('FakePyMongo', (object, ), {})()
+        storage.mongo.db = MongomockDatabase(mongomock.MongoClient().db, counter)
+        for collection, fields in INDEXES.items():
+            for field in fields:
+                storage.mongo.db[collection].ensure_index(field)
+        return storage, counter, False
+    raise ValueError('Unknown backend %s' % name)
+
+
+def make_manifest(uuid, name, developer, options):
+    return {
+        'uuid': uuid,
+        'name': name,
+        'type': 'python',
+        'description': 'application %s' % name,
+        'developer': developer,
+        'ref': uuid.rsplit('_', 1)[-1],
+        'args': 'main.py',
+        'structure': ['%s/module%d.py' % (name, i) for i in xrange(options.files)],
+        'changelog': ['%s change %d' % (uuid, i) for i in xrange(20)],
+    }
+
+
+class Workload(object):
+    def __init__(self, storage, counter, uploads, options):
+        self.storage = storage
+        self.counter = counter
+        self.uploads = uploads
+        self.options = options
+        self.tokens = ['token%d' % i for i in xrange(options.developers)]
+        self.uuids = []
+        self.profiles = ['default'] + ['profile%d' % i for i in xrange(9)]
+        self.runlists = ['default'] + ['runlist%d' % i for i in xrange(9)]
+        self.archive = os.urandom(options.archive_size)
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.ops = {}
+        self.sequence = 0
+
+    def measure(self, name, func, *args):
+        ops = self.counter.ops
+        started = time()
+        rv = func(*args)
+        elapsed = time() - started
+        with self.lock:
+            self.latencies.setdefault(name, []).append(elapsed)
+            self.ops[name] = self.ops.get(name, 0) + self.counter.ops - ops
+        return rv
+
+    def new_uuid(self, developer):
+        with self.lock:
+            self.sequence += 1
+            return 'app%d.user%s_%d' % (self.sequence, developer, self.sequence)
+
+    def fill(self):
+        s = self.storage
+        for i, token in enumerate(self.tokens):
+            s.create_user('user%d' % i, 'password', False, token)
+        for profile in self.profiles:
+            s.write_profile(profile, {'pool-limit': 10, 'heartbeat-timeout': 30})
+        for runlist in self.runlists:
+            s.write_runlist(runlist, {})
+        for i in xrange(self.options.hosts):
+            s.add_host('alias%d' % (i % 10), 'host%d.example.net' % i)
+        for i in xrange(self.options.manifests):
+            developer = self.tokens[i % len(self.tokens)]
+            uuid = self.new_uuid(developer)
+            s.write_manifest(uuid, make_manifest(uuid, 'app%d' % i, developer, self.options))
+            self.uuids.append(uuid)
+        if self.uploads:
+            for uuid in self.uuids[:self.options.rounds]:
+                s.save_app(uuid, StringIO(self.archive))
+
+    def deploy(self):
+        s = self.storage
+        uuid = random.choice(self.uuids)
+        profile = random.choice(self.profiles)
+        runlist = random.choice(self.runlists)
+        manifest = s.read_manifest(uuid)
+        s.read_runlist(runlist, {})
+        s.read_hosts()
+        s.read_profile(profile)
+        manifest['runlist'] = runlist
+        s.runlist_add(runlist, uuid, profile)
+        s.write_manifest(uuid, manifest)
+
+    def upload(self):
+        developer = random.choice(self.tokens)
+        uuid = self.new_uuid(developer)
+        self.storage.find_user_by_token(developer)
+        if self.uploads:
+            self.storage.save_app(uuid, StringIO(self.archive))
+        self.storage.write_manifest(uuid, make_manifest(uuid, uuid.split('.')[0], developer, self.options))
+
+    def download(self, uuid):
+        for _ in self.storage.iter_app(uuid):
+            pass
+
+    def single(self):
+        s = self.storage
+        rounds = self.options.rounds
+        for _ in xrange(rounds):
+            self.measure('find_user_by_token', s.find_user_by_token, random.choice(self.tokens))
+            self.measure('read_manifest', s.read_manifest, random.choice(self.uuids))
+            self.measure('read_hosts', s.read_hosts)
+            self.measure('read_profiles', s.read_profiles)
+            self.measure('read_runlists', s.read_runlists)
+        for _ in xrange(max(1, rounds / 10)):
+            self.measure('read_manifests', s.read_manifests)
+            self.measure('read_manifest_summaries', s.read_manifest_summaries)
+            self.measure('summaries of developer', s.read_manifest_summaries, random.choice(self.tokens))
+            self.measure('get_usernames_by_tokens', s.get_usernames_by_tokens, self.tokens)
+        if self.uploads:
+            for uuid in self.uuids[:rounds]:
+                self.measure('iter_app', self.download, uuid)
+
+    def concurrent(self):
+        jobs = [self.deploy if i % 2 else self.upload for i in xrange(self.options.jobs)]
+        random.shuffle(jobs)
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not jobs:
+                        return
+                    job = jobs.pop()
+                self.measure('concurrent ' + job.__name__, job)
+
+        threads = [threading.Thread(target=worker) for _ in xrange(self.options.concurrency)]
+        started = time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.options.jobs / (time() - started)
+
+
+def bench(name, options):
+    path = tempfile.mkdtemp(prefix='bench-storage-')
+    try:
+        backend = create_backend(name, options, path)
+        if backend is None:
+            return
+        storage, counter, uploads = backend
+        if options.cache:
+            storage.set_cache(ReadCache(options.cache))
+        storage.set_compression(options.compress_threshold)
+
+        workload = Workload(storage, counter, uploads, options)
+        started = time()
+        workload.fill()
+        filled = time() - started
+        workload.single()
+        throughput = workload.concurrent()
+
+        print
+        print '%s: catalog filled in %.2f s, %.1f jobs/s with %d threads%s' % (
+            name, filled, throughput, options.concurrency, '' if uploads else ', without app archives')
+        print '%-26s %8s %10s %10s %10s' % ('operation', 'calls', 'p50, ms', 'p99, ms', 'ops/call')
+        for op in sorted(workload.latencies):
+            latencies = workload.latencies[op]
+            print '%-26s %8d %10.3f %10.3f %10.1f' % (op, len(latencies), percentile(latencies, 50) * 1000,
+                                                    percentile(latencies, 99) * 1000,
+                                                    float(workload.ops[op]) / len(latencies))
+        sys.stdout.flush()
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='storage backends benchmark')
+    parser.add_argument('--backends', default=','.join(BACKENDS), help='comma separated backends')
+    parser.add_argument('--manifests', type=int, default=500, help='manifests in the catalog')
+    parser.add_argument('--developers', type=int, default=20, help='developers owning the manifests')
+    parser.add_argument('--hosts', type=int, default=100, help='hosts in the catalog')
+    parser.add_argument('--files', type=int, default=50, help='files in structure of every manifest')
+    parser.add_argument('--rounds', type=int, default=100, help='calls of every single threaded operation')
+    parser.add_argument('--concurrency', type=int, default=8, help='threads running deploys and uploads')
+    parser.add_argument('--jobs', type=int, default=200, help='deploys and uploads to run concurrently')
+    parser.add_argument('--archive-size', type=int, default=256 * 1024, help='size of uploaded apps, bytes')
+    parser.add_argument('--chunk-size', type=int, default=64 * 1024, help='APP_CHUNK_SIZE of storages')
+    parser.add_argument('--latency', type=float, default=0.0005, help='request latency of elliptics stand-in, seconds')
+    parser.add_argument('--cache', type=int, default=0, help='STORAGE_CACHE_SIZE, 0 disables the cache')
+    parser.add_argument('--compress-threshold', type=int, default=DEFAULT_COMPRESS_THRESHOLD,
+                        help='STORAGE_COMPRESS_THRESHOLD, 0 disables compression')
+    options = parser.parse_args()
+
+    random.seed(0)
+    for name in options.backends.split(','):
+        bench(name, options)
+
+
+if __name__ == '__main__':
+    main()
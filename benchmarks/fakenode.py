@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Stand-in for a set of cocaine nodes speaking the msgpack `[cmd, args]`
+    json rpc protocol used by cocaine.flow.rpc.
+
+    Every fake host is a ROUTER socket bound to its own port on one
+    interface, all of them are served by a single poller loop. Latency,
+    drop rate and reply size are configurable per host.
+"""
+import argparse
+import heapq
+import random
+import signal
+import zmq
+import msgpack
+from time import time
+
+
+START_APP = 0
+STOP_APP = 1
+INFO = 2
+
+
+class FakeHost(object):
+    def __init__(self, port, latency=0.0, jitter=0.0, drop_rate=0.0, reply_size=0):
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.payload = 'x' * reply_size
+        self.requests = 0
+        self.dropped = 0
+
+    def delay(self):
+        return max(0.0, random.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+
+    def reply(self, cmd, args):
+        if cmd == INFO:
+            return {'route': 'tcp://127.0.0.1:%d' % self.port,
+                    'requests': self.requests,
+                    'apps': {},
+                    'payload': self.payload}
+        elif cmd == START_APP:
+            return dict((uuid, {}) for uuid in args[0])
+        elif cmd == STOP_APP:
+            return dict((uuid, {}) for uuid in args[0])
+        return {'error': 'unknown command %s' % cmd}
+
+
+def serve(hosts, interface='127.0.0.1', stop=None):
+    """
+        Serves `hosts` (list of FakeHost) until `stop` event is set or the process is interrupted
+    """
+    context = zmq.Context()
+    poller = zmq.Poller()
+    sockets = {}
+    for host in hosts:
+        sock = context.socket(zmq.ROUTER)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.bind('tcp://%s:%d' % (interface, host.port))
+        poller.register(sock, zmq.POLLIN)
+        sockets[sock] = host
+
+    # (due time, sequence, socket, frames)
+    scheduled = []
+    sequence = 0
+    try:
+        while stop is None or not stop.is_set():
+            timeout = 100
+            if scheduled:
+                timeout = max(0, min(timeout, (scheduled[0][0] - time()) * 1000))
+
+            for sock, event in poller.poll(timeout):
+                host = sockets[sock]
+                while True:
+                    try:
+                        frames = sock.recv_multipart(zmq.NOBLOCK)
+                    except zmq.ZMQError:
+                        break
+
+                    host.requests += 1
+                    if host.drop_rate and random.random() < host.drop_rate:
+                        host.dropped += 1
+                        continue
+
+                    cmd, args = msgpack.unpackb(frames[-1])
+                    reply = frames[:-1] + [msgpack.packb(host.reply(cmd, args))]
+                    sequence += 1
+                    heapq.heappush(scheduled, (time() + host.delay(), sequence, sock, reply))
+
+            now = time()
+            while scheduled and scheduled[0][0] <= now:
+                due, seq, sock, reply = heapq.heappop(scheduled)
+                sock.send_multipart(reply)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for sock in sockets:
+            sock.close()
+        context.term()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake cocaine nodes')
+    parser.add_argument('-n', '--hosts', type=int, default=1, help='number of fake hosts')
+    parser.add_argument('-p', '--port', type=int, default=15000, help='port of the first host')
+    parser.add_argument('-i', '--interface', default='127.0.0.1')
+    parser.add_argument('-l', '--latency', type=float, default=0.0, help='reply latency, seconds')
+    parser.add_argument('-j', '--jitter', type=float, default=0.0, help='latency deviation, seconds')
+    parser.add_argument('-d', '--drop-rate', type=float, default=0.0, help='share of requests left unanswered')
+    parser.add_argument('-s', '--reply-size', type=int, default=0, help='padding of info replies, bytes')
+    options = parser.parse_args()
+
+    hosts = [FakeHost(options.port + i, options.latency, options.jitter, options.drop_rate, options.reply_size)
+             for i in xrange(options.hosts)]
+    print 'Serving %d fake hosts on %s:%d-%d' % (len(hosts), options.interface,
+                                                 options.port, options.port + len(hosts) - 1)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    serve(hosts, options.interface)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,13 @@ from flask import Flask
 import sys
 import yaml
 from storages import init_storage
+from cocaine.flow.rpc import init_rpc
+from cocaine.flow.builds import init_builds
+from cocaine.flow.collector import init_collector
+from cocaine.flow.depcache import init_depends_cache
+from cocaine.flow.gitcache import init_git_cache
+from cocaine.flow.usercache import init_user_cache
+from cocaine.flow.metrics import init_metrics
 import views
 
 try:
@@ -34,7 +41,9 @@ def create_app(settings_path='/etc/cocaine-flow/settings.yaml'):
     app.add_url_rule('/token', view_func=views.get_token, methods=['POST'])
     #Stats
     app.add_url_rule('/stats', 'stats', view_func=views.stats, methods=['GET'])
+    app.add_url_rule('/stats/stream', 'stats_stream', view_func=views.stats_stream, methods=['GET'])
     app.add_url_rule('/stats/<string:alias>/<string:host>', endpoint='host_stats', view_func=views.host_stats, methods=['GET'])
+    app.add_url_rule('/metrics', 'metrics', view_func=views.metrics, methods=['GET'])
     #Balances
     app.add_url_rule('/balances', 'balances', view_func=views.balances, methods=['GET'])
     app.add_url_rule('/balances/<string:group>/<string:app_name>', 'add_balances', view_func=views.add_balance_list, methods=['POST'])
@@ -45,6 +54,7 @@ def create_app(settings_path='/etc/cocaine-flow/settings.yaml'):
     # Deploy and Undeploy
     app.add_url_rule('/exists/<string:prefix>/<string:postfix>', view_func=views.exists)
     app.add_url_rule('/upload', endpoint="upload", view_func=views.upload, methods=['GET', 'POST'])
+    app.add_url_rule('/upload/<string:job_id>', endpoint="upload_status", view_func=views.upload_status, methods=['GET'])
     app.add_url_rule('/deploy/<string:runlist>/<string:uuid>/<string:profile>', endpoint="deploy",
                      view_func=views.deploy, methods=['POST'])
     app.add_url_rule('/undeploy/<string:runlist>/<string:uuid>/<string:profile>', endpoint="undeploy",
@@ -59,6 +69,8 @@ def create_app(settings_path='/etc/cocaine-flow/settings.yaml'):
     app.add_url_rule('/app/<string:app_name>', view_func=views.delete_app, methods=['DELETE'])
     app.add_url_rule('/app/start/<string:uuid>/<string:profile>', view_func=views.start_app, methods=['POST'])
     app.add_url_rule('/app/stop/<string:uuid>', view_func=views.stop_app, methods=['POST'])
+    app.add_url_rule('/app/download/<string:uuid>', view_func=views.download_app, methods=['GET'])
+    app.add_url_rule('/app/manifest/<string:uuid>', endpoint='manifest', view_func=views.get_manifest, methods=['GET'])
     #Runlists
     app.add_url_rule('/runlists', view_func=views.get_runlists)
     app.add_url_rule('/runlists/<string:name>', endpoint='create_runlist', view_func=views.create_runlist, methods=['POST'])
@@ -74,6 +86,13 @@ def create_app(settings_path='/etc/cocaine-flow/settings.yaml'):
     app.error_handler_spec[None][500] = views.error_handler
 
     init_storage(app)
+    init_rpc(app)
+    init_collector(app)
+    init_builds(app)
+    init_depends_cache(app)
+    init_git_cache(app)
+    init_user_cache(app)
+    init_metrics(app)
 
     logging.basicConfig(level=logging.DEBUG)
 
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+from Queue import Queue
+from time import time
+from uuid import uuid4
+from cocaine.flow.metrics import build_step_latency
+
+
+logger = logging.getLogger('builds')
+
+DEFAULT_WORKERS = 2
+# seconds, jobs unfinished for longer are considered lost with their worker
+DEFAULT_TIMEOUT = 3600
+# seconds, records of older jobs are removed by maintenance
+DEFAULT_TTL = 7 * 24 * 3600
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class BuildQueue(object):
+    """
+        Runs application builds in a pool of worker threads.
+
+        Job state is kept in storage, so any web worker process can answer
+        a status request for a job queued by another one. Threads are
+        started on first use in every process. The queue itself lives in
+        process memory, so jobs of a restarted process are failed once
+        they are older than `timeout`.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT, ttl=DEFAULT_TTL):
+        self.app = None
+        self.workers = workers
+        self.timeout = timeout
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.pid = None
+        self.queue = None
+
+    def configure(self, app, workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT, ttl=DEFAULT_TTL):
+        self.app = app
+        self.workers = int(workers)
+        self.timeout = int(timeout)
+        self.ttl = int(ttl)
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.queue = Queue()
+
+            for i in xrange(self.workers):
+                thread = threading.Thread(target=self._run, name='build-worker-%d' % i)
+                thread.daemon = True
+                thread.start()
+
+    def _update(self, job, **kwargs):
+        job.update(kwargs)
+        self.app.storage.write_build(job['id'], job)
+
+    def _run(self):
+        while True:
+            job, func, args = self.queue.get()
+            started = time()
+            build_step_latency.observe(started - job['created'], step='queue')
+            self._update(job, status=RUNNING, started=started)
+            try:
+                with self.app.app_context():
+                    rv = func(job['id'], *args)
+                if isinstance(rv, basestring):
+                    rv = rv, 200
+                result, code = rv
+            except Exception as e:
+                logger.exception('Build %s failed', job['id'])
+                result, code = 'Build failed. %s' % e, 500
+
+            self._update(job, status=DONE if 200 <= code < 300 else FAILED,
+                         result=result, code=code, finished=time())
+
+    def submit(self, func, *args, **fields):
+        """
+            Queues `func(job_id, *args)`, which returns a view-like result:
+            message or (message, http code). Extra `fields` are kept in the
+            job record. Returns id of the job.
+        """
+        self._ensure_started()
+        job = dict(fields, id=uuid4().hex, status=QUEUED, created=time())
+        self.app.storage.create_build(job['id'], job)
+        self.queue.put((job, func, args))
+        return job['id']
+
+    def get(self, job_id):
+        job = self.app.storage.read_build(job_id)
+        if job is not None and job['status'] in (QUEUED, RUNNING) and \
+                time() - job.get('started', job['created']) > self.timeout:
+            logger.warning('Build %s is lost', job_id)
+            self._update(job, status=FAILED, result='Build was lost by its worker', code=500, finished=time())
+        return job
+
+    def clean(self):
+        self.app.storage.clean_builds(time() - self.ttl)
+
+
+builds = BuildQueue()
+
+
+def init_builds(app):
+    builds.configure(app, app.config.get('BUILD_WORKERS', DEFAULT_WORKERS),
+                     app.config.get('BUILD_TIMEOUT', DEFAULT_TIMEOUT), app.config.get('BUILD_TTL', DEFAULT_TTL))
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import itertools
+import logging
+import os
+import threading
+from time import time, sleep
+from cocaine.flow.rpc import send_json_rpc
+
+
+logger = logging.getLogger('collector')
+
+DEFAULT_INTERVAL = 10
+
+
+class StatsCollector(object):
+    """
+        Polls `info` (json rpc command 2) from every host of the cluster in a
+        background thread and keeps the latest reply of each host in memory.
+
+        The thread is started on first use in every process, so gunicorn
+        workers forked after the app was created get their own collector.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.storage = None
+        self.lock = threading.Lock()
+        self.pid = None
+        self.hosts = {}
+        self.collected = None
+
+    def configure(self, storage, interval=DEFAULT_INTERVAL):
+        self.storage = storage
+        self.interval = float(interval or 0)
+
+    def cluster_hosts(self):
+        return set(itertools.chain(*self.storage.read_hosts().values()))
+
+    def collect(self):
+        hosts = self.cluster_hosts()
+        res = send_json_rpc(2, [], hosts)
+        now = time()
+        with self.lock:
+            previous = self.hosts
+            self.hosts = {}
+            for host, info in res.items():
+                if info is not None:
+                    self.hosts[host] = (info, now)
+                else:
+                    # keep the last known reply, its age tells how stale it is
+                    self.hosts[host] = previous.get(host, (None, None))
+            self.collected = now
+
+    def _run(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.collect()
+            except Exception:
+                logger.exception('Unable to collect cluster stats')
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.hosts = {}
+            self.collected = None
+
+        thread = threading.Thread(target=self._run, name='stats-collector')
+        thread.daemon = True
+        thread.start()
+
+    def snapshot(self):
+        """
+            Returns {host: (info or None, time of the reply or None)}
+        """
+        if not self.interval:
+            self.collect()
+            return dict(self.hosts)
+
+        self._ensure_started()
+        if self.collected is None:
+            self.collect()
+
+        with self.lock:
+            return dict(self.hosts)
+
+
+collector = StatsCollector()
+
+
+def init_collector(app):
+    collector.configure(app.storage, app.config.get('STATS_INTERVAL', DEFAULT_INTERVAL))
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import os
+from uuid import uuid4
+import sh
+
+
+logger = logging.getLogger('depcache')
+
+DEFAULT_SIZE = 1024 * 1024 * 1024
+
+# files which pin dependencies besides `depends` list of info.yaml
+LOCKFILES = {
+    'python': [],
+    'nodejs': ['package.json', 'npm-shrinkwrap.json', 'package-lock.json'],
+}
+
+
+def tree_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size += os.lstat(os.path.join(root, name)).st_size
+    return size
+
+
+class DependencyCache(object):
+    """
+        Installed dependencies keyed by app type and hash of the dependency list
+        and lockfiles. Every entry is a `<key>/tree` directory with a `<key>/size`
+        file, entries are evicted in least recently used order (mtime of the
+        entry directory) when the cache grows over `max_size` bytes.
+    """
+
+    def __init__(self, path=None, max_size=DEFAULT_SIZE):
+        self.configure(path, max_size)
+
+    def configure(self, path, max_size=DEFAULT_SIZE):
+        self.path = path
+        self.max_size = int(max_size or 0)
+
+    @property
+    def enabled(self):
+        return bool(self.path and self.max_size)
+
+    def key(self, type_, depends, src_path):
+        h = hashlib.sha1(type_)
+        for depend in sorted(set(d.strip() for d in depends or [])):
+            h.update('\0' + depend)
+        for lockfile in LOCKFILES.get(type_, []):
+            lockfile_path = os.path.join(src_path, lockfile)
+            if os.path.exists(lockfile_path):
+                with open(lockfile_path) as f:
+                    h.update('\0%s\0' % lockfile + f.read())
+        return '%s-%s' % (type_, h.hexdigest())
+
+    def restore(self, key, dest):
+        """
+            Copies cached tree to `dest`, returns False on miss
+        """
+        if not self.enabled:
+            return False
+
+        entry = os.path.join(self.path, key)
+        if not os.path.exists(os.path.join(entry, 'size')):
+            return False
+
+        try:
+            if os.path.exists(dest):
+                sh.rm("-rf", dest)
+            try:
+                sh.cp("-al", os.path.join(entry, 'tree'), dest)
+            except sh.ErrorReturnCode:
+                # cache and workspace are on different filesystems
+                sh.rm("-rf", dest)
+                sh.cp("-a", os.path.join(entry, 'tree'), dest)
+            os.utime(entry, None)
+        except (sh.ErrorReturnCode, OSError) as e:
+            logger.warning("Unable to restore dependencies %s from cache: %s", key, e)
+            sh.rm("-rf", dest)
+            return False
+
+        logger.debug("Restored dependencies %s from cache", key)
+        return True
+
+    def store(self, key, src):
+        if not self.enabled:
+            return
+
+        entry = os.path.join(self.path, key)
+        if os.path.exists(entry):
+            return
+
+        tmp = os.path.join(self.path, '.tmp-%s' % uuid4().hex)
+        try:
+            sh.mkdir("-p", tmp)
+            sh.cp("-a", src, os.path.join(tmp, 'tree'))
+            with open(os.path.join(tmp, 'size'), 'w') as f:
+                f.write(str(tree_size(tmp)))
+            os.rename(tmp, entry)
+        except (sh.ErrorReturnCode, OSError) as e:
+            # the same dependencies might have just been stored by another build
+            logger.debug("Unable to store dependencies %s in cache: %s", key, e)
+            sh.rm("-rf", tmp)
+            return
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for key in os.listdir(self.path):
+            if key.startswith('.'):
+                continue
+            entry = os.path.join(self.path, key)
+            try:
+                with open(os.path.join(entry, 'size')) as f:
+                    size = int(f.read())
+                entries.append((os.stat(entry).st_mtime, size, entry))
+            except (IOError, OSError, ValueError):
+                continue
+
+        total = sum(size for mtime, size, entry in entries)
+        for mtime, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            logger.debug("Evicting %s from dependency cache", entry)
+            tmp = os.path.join(self.path, '.tmp-%s' % uuid4().hex)
+            try:
+                os.rename(entry, tmp)
+            except OSError:
+                continue
+            sh.rm("-rf", tmp)
+            total -= size
+
+
+depends_cache = DependencyCache()
+
+
+def init_depends_cache(app):
+    default_path = os.path.join(app.config.get('UPLOAD_FOLDER', '/tmp'), 'depends-cache')
+    depends_cache.configure(app.config.get('DEPENDS_CACHE_PATH', default_path),
+                            app.config.get('DEPENDS_CACHE_SIZE', DEFAULT_SIZE))
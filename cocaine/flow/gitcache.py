@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import subprocess
+import tempfile
+from uuid import uuid4
+import sh
+
+
+logger = logging.getLogger('gitcache')
+
+# git log -5 is used as changelog of application
+DEFAULT_DEPTH = 5
+
+READ_SIZE = 64 * 1024
+
+# full or abbreviated commit sha
+SHA_RE = re.compile(r'^[0-9a-fA-F]{4,40}$')
+
+
+class GitError(Exception):
+    pass
+
+
+def valid_ref(ref):
+    """
+        Whether `ref` is a commit sha or a branch or tag name. Refs come from
+        users, anything else, e.g. options of git commands, is refused
+    """
+    if not ref or ref.startswith('-'):
+        return False
+    if SHA_RE.match(ref):
+        return True
+    try:
+        sh.git("check-ref-format", "--allow-onelevel", ref)
+    except sh.ErrorReturnCode:
+        return False
+    return True
+
+
+class GitMirrorCache(object):
+    """
+        Bare mirror per repository url, updated by shallow incremental fetches
+        of the requested ref only. Builds take their work tree out of the
+        mirror with `git archive`, so nothing is cloned twice.
+    """
+
+    def __init__(self, path=None, depth=DEFAULT_DEPTH):
+        self.configure(path, depth)
+
+    def configure(self, path, depth=DEFAULT_DEPTH):
+        self.path = path
+        self.depth = int(depth)
+
+    def mirror_path(self, url):
+        return os.path.join(self.path, hashlib.sha1(url).hexdigest() + '.git')
+
+    @contextmanager
+    def lock(self, mirror):
+        # builds run in threads of several web workers
+        with open(mirror + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def create_mirror(self, url, mirror):
+        tmp = os.path.join(self.path, '.tmp-%s' % uuid4().hex)
+        try:
+            sh.git("init", "--bare", "-q", tmp)
+            sh.git("remote", "add", "origin", url, _cwd=tmp)
+            os.rename(tmp, mirror)
+        finally:
+            if os.path.exists(tmp):
+                sh.rm("-rf", tmp)
+
+    def fetch(self, url, ref):
+        """
+            Updates mirror of `url` with `ref`. Returns (mirror path, commit sha)
+        """
+        if not valid_ref(ref):
+            raise GitError('Invalid reference %r' % ref)
+
+        sh.mkdir("-p", self.path)
+        mirror = self.mirror_path(url)
+        with self.lock(mirror):
+            if not os.path.exists(mirror):
+                logger.debug("Creating mirror of %s", url)
+                self.create_mirror(url, mirror)
+
+            try:
+                sh.git("fetch", "-q", "--depth", self.depth, "--end-of-options", "origin", ref, _cwd=mirror)
+                return mirror, sh.git("rev-parse", "FETCH_HEAD^{commit}", _cwd=mirror).strip()
+            except sh.ErrorReturnCode:
+                if not SHA_RE.match(ref):
+                    raise
+                # abbreviated sha or a commit which the server refuses to send by sha,
+                # it is looked for among commits fetched before. Nothing else is
+                # fetched: the mirror stays shallow
+                logger.debug("Unable to fetch %s of %s, looking for it in the mirror", ref, url)
+
+            try:
+                return mirror, sh.git("rev-parse", "--verify", "-q", "%s^{commit}" % ref, _cwd=mirror).strip()
+            except sh.ErrorReturnCode:
+                raise GitError('Commit %s is not found, use full sha or a branch or tag containing it' % ref)
+
+    def checkout(self, mirror, sha, dest):
+        """
+            Extracts tree of `sha` to `dest` directory
+        """
+        sh.mkdir("-p", dest)
+        with self.lock(mirror):
+            sh.tar(sh.git("archive", "--format=tar", sha, _cwd=mirror, _piped=True), "-x", "-C", dest)
+
+    @contextmanager
+    def archive(self, mirror, sha):
+        """
+            Yields tar stream of `sha`
+        """
+        # stderr goes to a file: git blocks on a full stderr pipe nobody reads
+        # while stdout is consumed
+        with tempfile.TemporaryFile() as errors:
+            proc = subprocess.Popen(["git", "archive", "--format=tar", sha], cwd=mirror,
+                                    stdout=subprocess.PIPE, stderr=errors)
+            try:
+                yield proc.stdout
+                # tail of the stream left unread, e.g. tar padding
+                while proc.stdout.read(READ_SIZE):
+                    pass
+            finally:
+                proc.stdout.close()
+                code = proc.wait()
+
+            # not reached if the stream reader failed, its error is propagated
+            if code != 0:
+                errors.seek(0)
+                raise GitError('git archive %s failed: %s' % (sha, errors.read()))
+
+    def changelog(self, mirror, sha, count=DEFAULT_DEPTH):
+        return sh.git("log", "-%d" % count, sha, date="short", format="%h %ad %s [%an]", _cwd=mirror)
+
+
+git_cache = GitMirrorCache()
+
+
+def init_git_cache(app):
+    default_path = os.path.join(app.config.get('UPLOAD_FOLDER', '/tmp'), 'git-cache')
+    git_cache.configure(app.config.get('GIT_CACHE_PATH', default_path),
+                        app.config.get('GIT_CACHE_DEPTH', DEFAULT_DEPTH))
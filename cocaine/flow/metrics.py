@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+from time import time
+from flask import request, g
+
+
+# seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BUILD_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def escape(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in pairs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    type_ = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type_)]
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.extend(self.samples(key, value))
+        return lines
+
+
+class Counter(Metric):
+    type_ = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self, key, value):
+        return ['%s%s %s' % (self.name, format_labels(self.labels, key), format_value(value))]
+
+
+class Histogram(Metric):
+    type_ = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'), )
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                # counts per bucket, sum of observed values
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time()
+        try:
+            yield
+        finally:
+            self.observe(time() - started, **labels)
+
+    def samples(self, key, value):
+        counts, total = value
+        labels = format_labels(self.labels, key)
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (self.name, format_labels(self.labels, key, [('le', format_value(bound))]),
+                                             cumulative))
+        lines.append('%s_sum%s %s' % (self.name, labels, format_value(total)))
+        lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+        return lines
+
+
+class Registry(object):
+    """
+        Metrics of the process in Prometheus text format. Every web worker
+        has its own registry, so they are scraped one by one like separate
+        instances.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+request_latency = registry.histogram('flow_http_request_duration_seconds',
+                                     'Time until response is sent, streamed bodies included', ['rule', 'method'])
+requests_total = registry.counter('flow_http_requests_total', 'Requests by status', ['rule', 'method', 'status'])
+
+storage_latency = registry.histogram('flow_storage_operation_duration_seconds',
+                                     'Latency of storage operations', ['operation'])
+storage_errors = registry.counter('flow_storage_errors_total', 'Failed storage operations, missed keys included',
+                                  ['operation', 'error'])
+
+rpc_latency = registry.histogram('flow_rpc_reply_duration_seconds', 'Time to json rpc reply of a host', ['host'])
+rpc_timeouts = registry.counter('flow_rpc_timeouts_total', 'Json rpc requests left unanswered in time', ['host'])
+rpc_errors = registry.counter('flow_rpc_errors_total', 'Json rpc requests failed to connect, send or receive',
+                              ['host'])
+
+build_step_latency = registry.histogram('flow_build_step_duration_seconds', 'Duration of application build steps',
+                                        ['step'], BUILD_BUCKETS)
+
+
+def request_rule():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def start_request():
+    g.metrics_started = time()
+
+
+def finish_request(response):
+    started = getattr(g, 'metrics_started', None)
+    if started is not None:
+        del g.metrics_started
+        rule, method = request_rule(), request.method
+        # streamed bodies are generated after views return, the server
+        # closes response once it is sent
+        response.call_on_close(lambda: request_latency.observe(time() - started, rule=rule, method=method))
+        requests_total.inc(rule=rule, method=method, status=response.status_code)
+    return response
+
+
+def fail_request(exc):
+    # requests are still started here only if an unhandled exception
+    # skipped after_request handlers
+    started = getattr(g, 'metrics_started', None)
+    if started is not None:
+        request_latency.observe(time() - started, rule=request_rule(), method=request.method)
+        requests_total.inc(rule=request_rule(), method=request.method, status=500)
+
+
+def timed_operation(storage, operation):
+    # resolved on every call: Elliptics storage wraps methods of its session,
+    # which is replaced by set_cache
+    method = getattr(type(storage), operation, None)
+
+    def call(*args, **kwargs):
+        bound = method.__get__(storage) if method is not None else storage.__getattr__(operation)
+        started = time()
+        try:
+            return bound(*args, **kwargs)
+        except Exception as e:
+            storage_errors.inc(operation=operation, error=type(e).__name__)
+            raise
+        finally:
+            storage_latency.observe(time() - started, operation=operation)
+
+    return call
+
+
+def instrument_storage(storage, operations=('read', 'write', 'bulk_read', 'remove', 'read_raw', 'write_raw')):
+    for operation in operations:
+        setattr(storage, operation, timed_operation(storage, operation))
+
+
+def init_metrics(app):
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(fail_request)
+    instrument_storage(app.storage)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+import hashlib
+import logging
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import os
+import struct
+import tarfile
+from time import time
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+logger = logging.getLogger('packer')
+
+# application info is stored in manifest, not in package, at any depth of the tree
+EXCLUDE = set(['info.yaml'])
+
+DEFAULT_CODEC = 'gzip'
+DEFAULT_LEVEL = 6
+BLOCK_SIZE = 1024 * 1024
+
+
+class HashingWriter(object):
+    """
+        File object wrapper which counts and hashes everything written through it
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha1()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        pass
+
+
+def deflate_block(data, level, last):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(object):
+    """
+        Writes a single member gzip stream whose deflate blocks are compressed
+        independently by a pool of threads (zlib releases GIL), like pigz does.
+        Every block but the last ends with a sync flush, so the blocks
+        concatenate into one valid deflate stream.
+    """
+
+    def __init__(self, fileobj, level=DEFAULT_LEVEL, workers=None, block_size=BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.workers = workers or cpu_count()
+        self.block_size = block_size
+        self.pool = ThreadPool(self.workers)
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+        self.crc = zlib.crc32('')
+        self.size = 0
+
+        self.fileobj.write('\x1f\x8b\x08\x00' + struct.pack('<I', int(time())) + '\x00\x03')
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._submit(False)
+
+    def _submit(self, last):
+        block = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.pending.append(self.pool.apply_async(deflate_block, (block, self.level, last)))
+        # keep memory bounded when compression is slower than input
+        while len(self.pending) > 2 * self.workers:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def flush(self):
+        pass
+
+    def close(self):
+        try:
+            self._submit(True)
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().get())
+            self.fileobj.write(struct.pack('<II', self.crc & 0xffffffff, self.size & 0xffffffff))
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+
+class LZ4Writer(object):
+    def __init__(self, fileobj, level=0, workers=None):
+        self.fileobj = fileobj
+        self.compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self.fileobj.write(self.compressor.begin())
+
+    def write(self, data):
+        self.fileobj.write(self.compressor.compress(data))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.fileobj.write(self.compressor.flush())
+
+
+class PlainWriter(object):
+    """
+        Passes tar through as is, it is hashed once by HashingWriter below
+    """
+
+    def __init__(self, fileobj, level=None, workers=None):
+        self.fileobj = fileobj
+
+    def write(self, data):
+        self.fileobj.write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# codec: (archive format, writer, default level), levels of lz4 above 2
+# select its several times slower HC compressor
+CODECS = {
+    'gzip': ('tar.gz', ParallelGzipWriter, DEFAULT_LEVEL),
+    'lz4': ('tar.lz4', LZ4Writer, 0),
+    'none': ('tar', PlainWriter, None),
+}
+
+
+def archive_format(codec):
+    if codec not in CODECS:
+        raise ValueError('Unsupported package codec %s' % codec)
+    if codec == 'lz4' and lz4 is None:
+        raise ValueError('lz4 package codec requires python lz4 module')
+    return CODECS[codec][0]
+
+
+def member_name(member):
+    if member.isdir():
+        return member.name.rstrip('/') + '/'
+    return member.name
+
+
+def pack(output, tree, depends=(), codec=DEFAULT_CODEC, level=None, workers=None):
+    """
+        Writes tar of `tree` (readable tar stream, e.g. output of git archive)
+        and `depends` ((path, name in archive) pairs) compressed with `codec`
+        to `output` in one pass, at `level` or the default level of the codec.
+
+        Returns package info: list of archived names as `structure` and
+        `archive` with format, codec, compressed and unpacked size and
+        sha1 of the package.
+    """
+    format_ = archive_format(codec)
+    structure = []
+    unpacked_size = [0]
+
+    def record(member):
+        structure.append(member_name(member))
+        unpacked_size[0] += member.size
+        return member
+
+    hashing = HashingWriter(output)
+    _, writer, default_level = CODECS[codec]
+    compressed = writer(hashing, default_level if level is None else level, workers)
+    dst = tarfile.open(fileobj=compressed, mode='w|')
+    try:
+        src = tarfile.open(fileobj=tree, mode='r|')
+        for member in src:
+            if os.path.basename(member.name) in EXCLUDE:
+                continue
+            record(member)
+            dst.addfile(member, src.extractfile(member) if member.isfile() else None)
+
+        for path, name in depends:
+            dst.add(path, arcname=name, filter=record)
+    finally:
+        dst.close()
+        compressed.close()
+
+    logger.debug("Packed %d entries, %d bytes", len(structure), hashing.size)
+    return {
+        'structure': structure,
+        'archive': {
+            'format': format_,
+            'codec': codec,
+            'size': hashing.size,
+            'unpacked_size': unpacked_size[0],
+            'sha1': hashing.hash.hexdigest(),
+        }
+    }
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import logging
+from cocaine.flow.rpc import send_json_rpc
+
+
+logger = logging.getLogger('rollout')
+
+# json rpc commands of cocaine node
+START_APP = 0
+STOP_APP = 1
+
+OK = 'ok'
+FAILED = 'failed'
+TIMEOUT = 'timeout'
+SKIPPED = 'skipped'
+ROLLED_BACK = 'rolled back'
+
+
+def reply_error(reply):
+    """
+        Returns error of start/stop reply or None if every app in it was processed
+    """
+    if not reply:
+        return 'Cocaine RPC didn\'t process call'
+
+    for app_uuid, res in reply.items():
+        if 'error' in res:
+            return "%s - %s" % (app_uuid, res['error'])
+    return None
+
+
+class Rollout(object):
+    """
+        Sends start/stop commands to the hosts in waves of `batch_size` hosts,
+        at most `max_inflight` hosts per rpc round. When less than
+        `success_threshold` of a wave succeeded, the rollout is aborted and
+        the hosts already switched are switched back.
+    """
+
+    def __init__(self, batch_size=None, max_inflight=None, success_threshold=1.0, timeout=0.5):
+        self.batch_size = batch_size
+        self.max_inflight = max_inflight
+        self.success_threshold = success_threshold
+        self.timeout = timeout
+
+    @staticmethod
+    def chunks(items, size):
+        if not size:
+            return [items] if items else []
+        return [items[i:i + size] for i in xrange(0, len(items), size)]
+
+    def call(self, cmd, args, hosts):
+        rv = {}
+        for chunk in self.chunks(hosts, self.max_inflight):
+            rv.update(send_json_rpc(cmd, args, chunk, self.timeout))
+        return rv
+
+    def run(self, cmd, args, hosts, undo=None):
+        """
+            `undo` is the (cmd, args) pair which reverts `cmd`.
+            Returns (success, {host: {'status': ..., 'error': ...}})
+        """
+        hosts = sorted(set(hosts))
+        results = dict((host, {'status': SKIPPED}) for host in hosts)
+        # hosts which switched or might have switched and didn't tell us
+        switched = []
+
+        for number, wave in enumerate(self.chunks(hosts, self.batch_size), 1):
+            succeeded = 0
+            for host, reply in self.call(cmd, args, wave).items():
+                error = reply_error(reply)
+                if error is None:
+                    results[host] = {'status': OK}
+                    switched.append(host)
+                    succeeded += 1
+                elif reply is None:
+                    results[host] = {'status': TIMEOUT, 'error': error}
+                    switched.append(host)
+                else:
+                    results[host] = {'status': FAILED, 'error': error}
+
+            logger.info("Wave %d: %d of %d hosts succeeded", number, succeeded, len(wave))
+            if succeeded < self.success_threshold * len(wave):
+                logger.error("Wave %d failed, aborting rollout", number)
+                if undo is not None and switched:
+                    self.rollback(undo, switched, results)
+                return False, results
+
+        return True, results
+
+    def rollback(self, undo, hosts, results):
+        cmd, args = undo
+        for host, reply in self.call(cmd, args, hosts).items():
+            error = reply_error(reply)
+            if error is None:
+                results[host] = {'status': ROLLED_BACK}
+            elif results[host]['status'] == OK:
+                results[host]['error'] = 'Rollback failed: %s' % error
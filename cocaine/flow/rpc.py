@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+from time import time
+import msgpack
+import zmq
+from cocaine.flow.metrics import rpc_latency, rpc_timeouts, rpc_errors
+
+
+logger = logging.getLogger('rpc')
+
+DEFAULT_PORT = 5000
+DEFAULT_IDLE_TIMEOUT = 60
+
+
+def endpoint(host, port=DEFAULT_PORT):
+    """
+        Returns (zmq tcp endpoint, whether it is IPv6) of `host`, which is a name
+        or an address with optional port: `name[:port]`, `ipv4[:port]`, `[ipv6][:port]`
+        or bare `ipv6` without port
+    """
+    if host.startswith('['):
+        address, _, rest = host[1:].partition(']')
+        port = rest[1:] if rest.startswith(':') else port
+        return 'tcp://[%s]:%s' % (address, port), True
+    if host.count(':') > 1:
+        return 'tcp://[%s]:%s' % (host, port), True
+    address, _, rest = host.partition(':')
+    return 'tcp://%s:%s' % (address, rest or port), False
+
+
+class Connection(object):
+    """
+        Long-lived DEALER socket to one cocaine node.
+
+        The protocol carries no request id, so a connection has at most one
+        request in flight and is reused only after its reply has arrived.
+        A connection whose request timed out or failed is closed, so a late
+        reply can never be taken for the answer to a later request.
+    """
+
+    def __init__(self, context, host, port=DEFAULT_PORT):
+        self.host = host
+        self.pid = os.getpid()
+        self.socket = context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        address, ipv6 = endpoint(host, port)
+        if ipv6:
+            self.socket.setsockopt(zmq.IPV6, 1)
+        self.socket.connect(address)
+        self.last_used = time()
+
+    def send(self, message):
+        self.socket.send(message, zmq.NOBLOCK)
+        self.last_used = time()
+
+    def recv(self):
+        return self.socket.recv(zmq.NOBLOCK)
+
+    def close(self):
+        self.socket.close()
+
+
+class ConnectionPool(object):
+    """
+        Process-wide pool of idle connections keyed by host.
+
+        Connections are checked out for the duration of one call, so a
+        socket is never used by two threads at once. The pool is rebuilt
+        with a fresh context after fork, so every worker gets its own sockets.
+    """
+
+    def __init__(self, port=DEFAULT_PORT, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.context = None
+        self.idle = {}
+        self.configure(port, idle_timeout)
+
+    def configure(self, port=DEFAULT_PORT, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.port = int(port)
+        self.idle_timeout = float(idle_timeout)
+
+    def _check_pid(self):
+        # sockets of the parent process must not be touched after fork
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.context = zmq.Context()
+            self.idle = {}
+
+    def _evict_idle(self):
+        now = time()
+        for host, conn in self.idle.items():
+            if now - conn.last_used > self.idle_timeout:
+                logger.debug("Closing idle connection to %s", host)
+                del self.idle[host]
+                conn.close()
+
+    def acquire(self, host):
+        with self.lock:
+            self._check_pid()
+            self._evict_idle()
+            conn = self.idle.pop(host, None)
+            context = self.context
+
+        if conn is None:
+            conn = Connection(context, host, self.port)
+        return conn
+
+    def release(self, conn):
+        """
+            Returns a connection whose reply has been received to the pool
+        """
+        with self.lock:
+            if conn.pid != self.pid or conn.host in self.idle:
+                conn.close()
+                return
+            self.idle[conn.host] = conn
+
+    def close(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                for conn in self.idle.values():
+                    conn.close()
+            self.idle = {}
+
+
+pool = ConnectionPool()
+
+
+def init_rpc(app):
+    pool.configure(app.config.get('RPC_PORT', DEFAULT_PORT),
+                   app.config.get('RPC_IDLE_TIMEOUT', DEFAULT_IDLE_TIMEOUT))
+
+
+def iter_json_rpc(cmd, args, hosts, timeout=0.5):
+    """
+        Send `[cmd, args]` to every host at once and yield `(host, reply)`
+        as soon as each reply arrives. Hosts which didn't answer in
+        `timeout` seconds are yielded last as `(host, None)`.
+    """
+    if isinstance(hosts, basestring):
+        hosts = [hosts]
+
+    message = msgpack.packb([cmd, args])
+    poller = zmq.Poller()
+    pending = {}
+    failed = []
+    seen = set()
+    for host in hosts:
+        if host in seen:
+            continue
+        seen.add(host)
+        try:
+            conn = pool.acquire(host)
+        except zmq.ZMQError as err:
+            logger.error("Unable to connect to %s: %s", host, err)
+            rpc_errors.inc(host=host)
+            failed.append(host)
+            continue
+
+        try:
+            conn.send(message)
+        except zmq.ZMQError as err:
+            logger.error("Unable to send json rpc to %s: %s", host, err)
+            rpc_errors.inc(host=host)
+            conn.close()
+            failed.append(host)
+            continue
+
+        poller.register(conn.socket, zmq.POLLIN)
+        pending[conn.socket] = conn
+
+    deadline = time() + timeout
+    try:
+        while pending:
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+
+            for sock, event in poller.poll(remaining * 1000):
+                conn = pending[sock]
+                try:
+                    data = conn.recv()
+                except zmq.ZMQError as err:
+                    if err.errno == zmq.EAGAIN:
+                        continue
+                    logger.error("Unable to receive json rpc reply from %s: %s", conn.host, err)
+                    rpc_errors.inc(host=conn.host)
+                    del pending[sock]
+                    poller.unregister(sock)
+                    conn.close()
+                    failed.append(conn.host)
+                    continue
+
+                rpc_latency.observe(time() - conn.last_used, host=conn.host)
+                del pending[sock]
+                poller.unregister(sock)
+                pool.release(conn)
+                yield conn.host, msgpack.unpackb(data)
+    finally:
+        # the reply may still come, so the connection can't be reused
+        for conn in pending.values():
+            failed.append(conn.host)
+            rpc_timeouts.inc(host=conn.host)
+            conn.close()
+        pending.clear()
+
+    for host in failed:
+        yield host, None
+
+
+def send_json_rpc(cmd, args, hosts, timeout=0.5):
+    """
+        Returns {host: reply} for all hosts, None for hosts which didn't answer in time.
+    """
+    return dict(iter_json_rpc(cmd, args, hosts, timeout))
@@ -1,16 +1,28 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+import os
 from werkzeug.local import LocalProxy
 from flask import current_app
+from .cache import create_cache
+from .storage import DEFAULT_CHUNK_SIZE, DEFAULT_COMPRESS_THRESHOLD, DEFAULT_COMPRESS_PREFIXES
 
 
 def connect_to_database(app):
     if app.config['STORAGE'] == 'elliptics':
         from .elliptics import Elliptics
-        return Elliptics(app.config['ELLIPTICS_NODES'], app.config['ELLIPTICS_GROUPS'])
+        return Elliptics(app.config['ELLIPTICS_NODES'], app.config['ELLIPTICS_GROUPS'],
+                         app.config.get('APP_CHUNK_SIZE', DEFAULT_CHUNK_SIZE),
+                         app.config.get('ELLIPTICS_NODE_ARCHIVES', True))
     elif app.config['STORAGE'] == 'mongo':
         from .mongo import Mongo
         return Mongo(app)
+    elif app.config['STORAGE'] == 'local':
+        from .local import Local
+        return Local(app.config.get('LOCAL_STORAGE_PATH', os.path.join(app.config.get('UPLOAD_FOLDER', '/tmp'), 'storage')),
+                     app.config.get('APP_CHUNK_SIZE', DEFAULT_CHUNK_SIZE))
+    elif app.config['STORAGE'] == 'memory':
+        from .memory import Memory
+        return Memory(app.config.get('APP_CHUNK_SIZE', DEFAULT_CHUNK_SIZE))
     raise ValueError('Unsupported type of storage')
 
 
@@ -20,6 +32,9 @@ def get_storage():
 
 def init_storage(app):
     app.storage = connect_to_database(app)
+    app.storage.set_cache(create_cache(app.config))
+    app.storage.set_compression(app.config.get('STORAGE_COMPRESS_THRESHOLD', DEFAULT_COMPRESS_THRESHOLD),
+                                app.config.get('STORAGE_COMPRESS_PREFIXES', DEFAULT_COMPRESS_PREFIXES))
 
 
 storage = LocalProxy(get_storage)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+import threading
+from time import time
+
+
+DEFAULT_SIZE = 1024
+DEFAULT_TTL = 5
+
+# app archives and build jobs are never cached
+DEFAULT_POLICIES = {
+    'apps': 0,
+    'appinfo': 0,
+    'blobs': 0,
+    'blobchunks': 0,
+    'appchunks': 0,
+    'builds': 0,
+}
+
+
+class ReadCache(object):
+    """
+        LRU of storage reads bounded by number of entries. Every entry
+        expires after ttl of the longest policy prefix matching its key
+        (`\\0` of storage keys is written as `:` in policies, ttl 0 means
+        the keys are not cached).
+
+        Own writes and removes of the storage invalidate the keys, changes
+        made by other processes are seen after ttl at most.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE, ttl=DEFAULT_TTL, policies=None):
+        self.size = int(size)
+        self.ttl = ttl
+        self.policies = dict(DEFAULT_POLICIES)
+        self.policies.update(policies or {})
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # bumped by every invalidation, so a read which started before
+        # a write can't put the old value back
+        self.generation = 0
+        self.hits = self.misses = 0
+
+    def ttl_for(self, key):
+        name = key.replace('\0', ':')
+        ttl, matched = self.ttl, -1
+        for prefix, prefix_ttl in self.policies.iteritems():
+            if len(prefix) > matched and (name == prefix or name.startswith(prefix + ':')):
+                ttl, matched = prefix_ttl, len(prefix)
+        return ttl
+
+    def get(self, key, default=None):
+        """
+            Returns cached value of `key`, `default` if it isn't cached
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] > time():
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return default
+
+    def fetch(self, key, load):
+        """
+            Returns cached value of `key` or result of `load()`
+        """
+        ttl = self.ttl_for(key)
+        if not ttl:
+            return load()
+
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] > time():
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self.generation
+
+        value = load()
+        self.put(key, value, ttl, generation)
+        return value
+
+    def put(self, key, value, ttl, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (time() + ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def fetch_many(self, keys, load):
+        """
+            Returns {key: value} of `keys`, missed ones are read by `load(keys)`
+        """
+        rv, missed = {}, []
+        now = time()
+        with self.lock:
+            generation = self.generation
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] > now:
+                    self.entries[key] = self.entries.pop(key)
+                    rv[key] = entry[1]
+                    self.hits += 1
+                else:
+                    missed.append(key)
+                    self.misses += 1
+
+        if missed:
+            loaded = load(missed)
+            for key, value in loaded.iteritems():
+                ttl = self.ttl_for(key)
+                if ttl:
+                    self.put(key, value, ttl, generation)
+            rv.update(loaded)
+        return rv
+
+    def invalidate(self, *keys):
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+
+class CachedSession(object):
+    """
+        Elliptics session wrapper serving reads through ReadCache
+    """
+
+    def __init__(self, session, cache):
+        self.session = session
+        self.cache = cache
+
+    def read(self, key):
+        return self.cache.fetch(key, lambda: self.session.read(key))
+
+    def bulk_read(self, keys):
+        return self.cache.fetch_many(keys, self.session.bulk_read)
+
+    def write(self, key, data, *args, **kwargs):
+        try:
+            return self.session.write(key, data, *args, **kwargs)
+        finally:
+            self.cache.invalidate(key)
+
+    def write_data(self, key, data, *args, **kwargs):
+        try:
+            return self.session.write_data(key, data, *args, **kwargs)
+        finally:
+            self.cache.invalidate(key)
+
+    def remove(self, key, *args, **kwargs):
+        try:
+            return self.session.remove(key, *args, **kwargs)
+        finally:
+            self.cache.invalidate(key)
+
+    def __getattr__(self, item):
+        return getattr(self.session, item)
+
+
+def create_cache(config):
+    size = config.get('STORAGE_CACHE_SIZE', 0)
+    if not size:
+        return None
+    return ReadCache(size, config.get('STORAGE_CACHE_TTL', DEFAULT_TTL), config.get('STORAGE_CACHE_POLICIES'))
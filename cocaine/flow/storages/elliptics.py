@@ -2,19 +2,53 @@
 from __future__ import absolute_import
 from collections import Iterable
 from copy import copy
+import hashlib
 import logging
-import msgpack
-from .storage import Storage
-from elliptics import Logger, Node
+import struct
+import threading
+from time import time
+from .cache import CachedSession
+from .storage import Storage, BLOB_GRACE_PERIOD, DEFAULT_CHUNK_SIZE, as_bytes, file_digest, limit_chunks, manifest_summary, unpack_value
 import traceback
 from storages.exceptions import UserExists
 
 
 logger = logging.getLogger('storages.elliptics')
 
+# updates of blob records in the process are serialized by these, picked by digest
+blob_locks = [threading.Lock() for _ in xrange(64)]
+
+
+def blob_lock(digest):
+    return blob_locks[int(digest[:8], 16) % len(blob_locks)]
+
+
+def raw_header(size):
+    """
+        Header msgpack puts before a `size` bytes string, so archives are
+        written for nodes as msgpack values without packing them
+    """
+    if size < 32:
+        return chr(0xa0 | size)
+    if size < 0x10000:
+        return '\xda' + struct.pack('>H', size)
+    return '\xdb' + struct.pack('>I', size)
+
+
+# updates of `list:manifests` and summaries indexes in the process; writers in
+# other processes may still overwrite each other, maintenance repairs the indexes
+index_lock = threading.RLock()
+
 
 class Elliptics(Storage):
-    def __init__(self, nodes, groups):
+    # cocaine nodes read app archives from `apps\0<uuid>` as one msgpack value
+    node_archives = True
+
+    def __init__(self, nodes, groups, chunk_size=DEFAULT_CHUNK_SIZE, node_archives=True):
+        from elliptics import Logger, Node
+
+        self.chunk_size = chunk_size
+        self.node_archives = node_archives
         self.node = Node(Logger("/tmp/cocainoom-elliptics.log"))
         for host, port in nodes.iteritems():
             try:
@@ -32,6 +66,12 @@ class Elliptics(Storage):
 
         self.storage.add_groups(groups)
 
+    def set_cache(self, cache):
+        # packed values are cached, so every read unpacks its own copy
+        super(Elliptics, self).set_cache(cache)
+        if cache is not None:
+            self.storage = CachedSession(self.storage, cache)
+
     def key(self, key, *args):
         prefix = key
         postfix = args[0]
@@ -56,6 +96,51 @@ class Elliptics(Storage):
 
         return key.replace(prefix, '')
 
+    def read(self, key, cached=True):
+        """
+            Reads past the read cache if `cached` is False: values about to be
+            modified are read so, the cache may hold them up to a ttl stale
+        """
+        session = self.storage
+        if not cached and isinstance(session, CachedSession):
+            session = session.session
+        return unpack_value(session.read(key))
+
+    def read_raw(self, key, offset=0, size=0):
+        """
+            Also reads `size` bytes (the rest if 0) from `offset` only
+        """
+        return self.storage.read_data(key, offset, size)
+
+    def write_raw(self, key, data, offset=0):
+        """
+            Also writes `data` at `offset` of a value, keeping the rest of it
+        """
+        return self.storage.write_data(key, as_bytes(data), offset)
+
+    def exists(self, key):
+        """
+            App archives aren't read: their `appinfo` records tell whether apps
+            exist. Other keys are looked up if the binding can, read otherwise
+        """
+        prefix, _, name = key.partition('\0')
+        if prefix == 'apps':
+            try:
+                self.read_raw(self.key('appinfo', name))
+                return True
+            except RuntimeError:
+                # app saved before `appinfo` records
+                pass
+
+        lookup = getattr(self.storage, 'lookup', None)
+        if lookup is None:
+            return super(Elliptics, self).exists(key)
+        try:
+            lookup(key)
+        except RuntimeError:
+            return False
+        return True
+
     #========================================================================================
     """
       Operations with Entities:
@@ -69,7 +154,7 @@ class Elliptics(Storage):
         entities = s.bulk_read(s.key(prefix, s.read(s.key(list_prefix, list_postfix))))
         entities = self.remove_prefix(prefix, entities)
         for k, entity in entities.items():
-            entity_unpacked = msgpack.unpackb(entity, list_hook=list)
+            entity_unpacked = unpack_value(entity, list_hook=list)
             entities[k] = entity_unpacked
         return entities
 
@@ -90,7 +175,7 @@ class Elliptics(Storage):
         """
         s = self
         rv = {}
-        entities_keys = s.read(s.key(list_prefix, list_postfix))
+        entities_keys = s.read(s.key(list_prefix, list_postfix), cached=False)
         if not isinstance(entities_keys, Iterable):
             s.write(s.key(list_prefix, list_postfix), list())
             return
@@ -118,7 +203,7 @@ class Elliptics(Storage):
         storage_key = self.key(prefix, postfix)
         try:
             logger.info("Reading from elliptics %s", storage_key)
-            entities = set(self.read(storage_key))
+            entities = set(self.read(storage_key, cached=False))
         except RuntimeError:
             if raise_on_missed_key: raise
             entities = set()
@@ -131,7 +216,7 @@ class Elliptics(Storage):
     def list_remove(self, prefix, postfix, value):
 
         list_key = self.key(prefix, postfix)
-        entities = set(self.read(list_key))
+        entities = set(self.read(list_key, cached=False))
 
         if value in entities:
             entities.remove(value)
@@ -154,10 +239,100 @@ class Elliptics(Storage):
             return default
 
     def write_manifest(self, uuid, manifest):
-        self.write_entity("manifests", uuid, "system", "list:manifests", manifest)
+        with index_lock:
+            self.write_entity("manifests", uuid, "system", "list:manifests", manifest)
+            self.update_summaries(uuid, manifest_summary(manifest))
 
     def clean_manifests(self):
-        return self.clean_entities("manifests", "system", "list:manifests")
+        """
+            Also rebuilds summaries indexes from `list:manifests`, repairing
+            updates lost to concurrent writers
+        """
+        with index_lock:
+            return self.rebuild_summaries()
+
+    def rebuild_summaries(self):
+        manifests = self.clean_entities("manifests", "system", "list:manifests")
+        if manifests is not None:
+            try:
+                previous = self.read(self.summaries_key(), cached=False)
+            except RuntimeError:
+                previous = {}
+            summaries = dict((uuid, manifest_summary(manifest)) for uuid, manifest in manifests.items())
+            self.write(self.summaries_key(), summaries)
+            # developers whose apps are all gone get empty indexes
+            developers = set(summary.get('developer') for summary in summaries.values() + previous.values())
+            for developer in developers:
+                self.write_developer_summaries(developer, summaries)
+        return manifests
+
+    def summaries_key(self, developer=None):
+        if developer is None:
+            return self.key("system", "index:manifests")
+        return self.key("system", "index:manifests:%s" % developer)
+
+    def read_manifest_summaries(self, developer=None):
+        """
+            Summaries of all manifests are kept in a single `system\0index:manifests`
+            value, summaries of apps of every developer in `system\0index:manifests:<token>`
+        """
+        try:
+            return self.read(self.summaries_key(developer))
+        except RuntimeError:
+            pass
+
+        if developer is not None:
+            # the index of the developer isn't built yet
+            return dict((uuid, summary) for uuid, summary in self.read_manifest_summaries().items()
+                        if summary.get('developer') == developer)
+
+        # the index is created by the first manifest write or by maintenance
+        return dict((uuid, manifest_summary(manifest)) for uuid, manifest in self.read_manifests().items())
+
+    def write_developer_summaries(self, developer, summaries):
+        """
+            Writes index of `developer` from all `summaries`, an empty one if
+            the developer has no apps: a missed index is read from the global one
+        """
+        self.write(self.summaries_key(developer),
+                   dict((uuid, summary) for uuid, summary in summaries.items()
+                        if summary.get('developer') == developer))
+
+    def update_developer_summaries(self, developer, uuid, summary, summaries):
+        try:
+            developer_summaries = self.read(self.summaries_key(developer), cached=False)
+        except RuntimeError:
+            self.write_developer_summaries(developer, summaries)
+            return
+
+        developer_summaries.pop(uuid, None)
+        if summary is not None and summary.get('developer') == developer:
+            developer_summaries[uuid] = summary
+        self.write(self.summaries_key(developer), developer_summaries)
+
+    def update_summaries(self, uuid, summary=None):
+        """
+            Sets summary of `uuid` in the indexes, removes it if `summary` is None
+        """
+        with index_lock:
+            self.update_summaries_locked(uuid, summary)
+
+    def update_summaries_locked(self, uuid, summary):
+        try:
+            summaries = self.read(self.summaries_key(), cached=False)
+        except RuntimeError:
+            summaries = self.read_manifest_summaries()
+
+        previous = summaries.pop(uuid, None)
+        if summary is not None:
+            summaries[uuid] = summary
+        elif previous is None:
+            return
+        self.write(self.summaries_key(), summaries)
+
+        developers = set(s.get('developer') for s in (previous, summary) if s is not None)
+        for developer in developers:
+            self.update_developer_summaries(developer, uuid, summary, summaries)
 
     #======================================================================================
     """
@@ -167,9 +342,9 @@ class Elliptics(Storage):
     def write_runlist(self, runlist_name, runlist):
         self.write_entity("runlists", runlist_name, "system", "list:runlists", runlist)
 
-    def read_runlist(self, runlist_name, default=None):
+    def read_runlist(self, runlist_name, default=None, cached=True):
         try:
-            return self.read(self.key("runlists", runlist_name))
+            return self.read(self.key("runlists", runlist_name), cached)
         except RuntimeError:
             return default
 
@@ -177,6 +352,9 @@ class Elliptics(Storage):
         res = self.read_entities("runlists", "system", "list:runlists")
         return res
 
+    def read_runlist_names(self):
+        return self.read(self.key("system", "list:runlists"))
+
     def delete_runlist(self, runlist_name):
         runlists = self.read_runlists()
         if runlist_name not in runlists:
@@ -189,9 +367,7 @@ class Elliptics(Storage):
         #clean invalid apps from runlists
         for runlist_name, runlist in runlists.items():
             for app_uuid, profile_name in runlist.items():
-                try:
-                    self.read(self.key("apps", app_uuid))
-                except RuntimeError:
+                if self.stat_app(app_uuid) is None:
                     del runlists[runlist_name][app_uuid]
 
                 try:
@@ -234,10 +410,10 @@ class Elliptics(Storage):
         Hosts
     """
 
-    def read_hosts(self):
+    def read_hosts(self, cached=True):
         hosts_key = self.key('system', "list:hosts")
         try:
-            hosts = dict(self.read(hosts_key))
+            hosts = dict(self.read(hosts_key, cached))
         except RuntimeError:
             hosts = {}
         return hosts
@@ -246,7 +422,7 @@ class Elliptics(Storage):
         self.write(self.key('system', "list:hosts"), hosts)
 
     def add_host(self, alias, host):
-        hosts = self.read_hosts()
+        hosts = self.read_hosts(cached=False)
         #hosts.setdefault(alias, ).append(host)
         # why tuple instead list
         l = hosts.get(alias)
@@ -259,7 +435,7 @@ class Elliptics(Storage):
         self.write_hosts(hosts)
 
     def delete_host(self, alias, host):
-        hosts = self.read_hosts()
+        hosts = self.read_hosts(cached=False)
         if alias not in hosts:
             return
         l = hosts.get(alias)
@@ -273,12 +449,12 @@ class Elliptics(Storage):
         self.write_hosts(hosts)
 
     def clean_hosts(self):
-        hosts = self.read(self.key('system', "list:hosts"))
+        hosts = self.read(self.key('system', "list:hosts"), cached=False)
         if not isinstance(hosts, dict):
             self.write(self.key('system', "list:hosts"), {})
 
     def delete_alias(self, alias):
-        hosts = self.read_hosts()
+        hosts = self.read_hosts(cached=False)
         if alias not in hosts:
             return
         hosts.pop(alias)
@@ -310,18 +486,300 @@ class Elliptics(Storage):
         else:
             return username
 
+    def get_usernames_by_tokens(self, tokens):
+        tokens = list(tokens)
+        if not tokens:
+            return {}
+        usernames = self.remove_prefix('tokens', self.bulk_read(self.key('tokens', tokens)))
+        return dict((token, unpack_value(username)) for token, username in usernames.items())
+
     #==================================================================
     """
         App operations
     """
 
+    def chunk_key(self, prefix, name, number):
+        return self.key(prefix, '%s:%d' % (name, number))
+
+    def write_chunks(self, prefix, name, data):
+        """
+            Streams `data` file object to storage by raw chunks, returns (chunks, size)
+        """
+        chunks = size = 0
+        while True:
+            chunk = data.read(self.chunk_size)
+            if not chunk:
+                break
+            self.write_raw(self.chunk_key(prefix, name, chunks), chunk)
+            chunks += 1
+            size += len(chunk)
+        return chunks, size
+
+    def write_archive(self, key, data, size):
+        """
+            Streams `data` file object of `size` bytes to `key` as a msgpack
+            string, which nodes read: its header, then raw chunks at their offsets
+        """
+        # writes at offsets don't truncate the archive of the previous upload
+        self.remove_quietly(key)
+        offset = 0
+        chunk = raw_header(size)
+        while chunk:
+            self.write_raw(key, chunk, offset)
+            offset += len(chunk)
+            chunk = data.read(self.chunk_size)
+
+    def iter_archive(self, key, start, end):
+        for offset in xrange(start, end, self.chunk_size):
+            yield self.read_raw(key, offset, min(self.chunk_size, end - offset))
+
+    def iter_chunks(self, prefix, name, chunks, first=0, raw=True):
+        # chunks written before raw blobs are packed with msgpack
+        read = self.read_raw if raw else self.read
+        for number in xrange(first, chunks):
+            yield read(self.chunk_key(prefix, name, number))
+
+    def remove_chunks(self, prefix, name, chunks):
+        for number in xrange(chunks):
+            try:
+                self.remove(self.chunk_key(prefix, name, number))
+            except RuntimeError:
+                logger.warning("Chunk %d of %s is already removed", number, name)
+
+    def read_app_info(self, uuid):
+        """
+            {'hash': sha1 of archive, 'size': bytes, 'node': whether the archive
+            is in `apps\0<uuid>` rather than in a blob}, or what `apps\0<uuid>`
+            holds for apps saved before: the archive itself or
+            {'chunks': number, 'chunk_size': bytes} of its own chunks
+        """
+        try:
+            return self.read(self.key('appinfo', uuid))
+        except RuntimeError:
+            return self.read(self.key('apps', uuid))
+
+    def read_blob_info(self, digest):
+        """
+            {'chunks': number, 'size': bytes, 'chunk_size': bytes, 'refs': [app uuids],
+             'raw': whether chunks are stored without msgpack}
+        """
+        try:
+            return self.read(self.key('blobs', digest))
+        except RuntimeError:
+            return None
+
     def save_app(self, uuid, data):
-        self.write(self.key("apps", uuid), data.read())
+        """
+            Cocaine nodes read the archive from `apps\0<uuid>` as one msgpack
+            value, so unless node_archives is off it is streamed there and
+            served from there.
+
+            Otherwise archives are stored once per content: chunks of the blob
+            are written only if no app with the same sha1 exists, and
+            `appinfo\0<uuid>` refers to the blob by its hash.
+        """
+        digest, size = file_digest(data, self.chunk_size)
+        try:
+            previous = self.read_app_info(uuid)
+        except RuntimeError:
+            previous = None
+
+        if self.node_archives:
+            if isinstance(previous, dict) and previous.get('node') and previous['hash'] == digest:
+                # `appinfo` is written after the archive, so the archive is complete
+                logger.info("App %s is uploaded again with the same archive", uuid)
+                return
+            data.seek(0)
+            self.write_archive(self.key('apps', uuid), data, size)
+            self.write(self.key('appinfo', uuid), {'hash': digest, 'size': size, 'node': True})
+            if previous is not None:
+                self.release_app_blob(uuid, previous)
+            return
+
+        with blob_lock(digest):
+            blob = self.read_blob_info(digest)
+            if blob is None:
+                chunks, size = self.write_chunks('blobchunks', digest, data)
+                blob = {'chunks': chunks, 'size': size, 'chunk_size': self.chunk_size, 'refs': [], 'raw': True}
+            else:
+                logger.info("App %s has the same archive as %s", uuid, blob['refs'])
+
+            if uuid not in blob['refs'] or 'released' in blob:
+                if uuid not in blob['refs']:
+                    blob['refs'].append(uuid)
+                blob.pop('released', None)
+                # blob info is written after its chunks, so the blob is visible only when complete
+                self.write(self.key('blobs', digest), blob)
+
+        self.write(self.key('appinfo', uuid), {'hash': digest, 'size': size})
+        if previous is not None:
+            # nodes must not see the archive of the previous upload
+            self.remove_quietly(self.key('apps', uuid))
+            self.release_app_blob(uuid, previous, keep=digest)
+
+    def release_app_blob(self, uuid, info, keep=None):
+        if not isinstance(info, dict):
+            # app stored as a single value
+            return
+
+        if 'hash' not in info:
+            # app stored by chunks of its own
+            self.remove_chunks('appchunks', uuid, info['chunks'])
+            return
+
+        digest = info['hash']
+        if digest == keep:
+            return
+        with blob_lock(digest):
+            blob = self.read_blob_info(digest)
+            if blob is None or uuid not in blob['refs']:
+                return
+
+            blob['refs'].remove(uuid)
+            if not blob['refs']:
+                # chunks are left to clean_apps: an upload of the same content
+                # in another process may be referring to them right now
+                blob['released'] = time()
+            self.write(self.key('blobs', digest), blob)
+
+        if not blob['refs']:
+            logger.info("Blob %s is released", digest)
+            self.list_add("system", "list:released-blobs", digest)
+
+    def clean_apps(self):
+        """
+            Removes blobs released more than BLOB_GRACE_PERIOD ago. Refs of
+            blobs which apps still refer to are repaired instead.
+        """
+        released_key = self.key("system", "list:released-blobs")
+        try:
+            released = self.read(released_key)
+        except RuntimeError:
+            return
+
+        try:
+            uuids = self.read(self.key("system", "list:manifests"))
+        except RuntimeError:
+            uuids = []
+        live = {}
+        infos = self.remove_prefix('appinfo', self.bulk_read(self.key('appinfo', uuids)))
+        for uuid, info in infos.items():
+            live.setdefault(unpack_value(info)['hash'], []).append(uuid)
+
+        kept = []
+        now = time()
+        for digest in set(released):
+            with blob_lock(digest):
+                blob = self.read_blob_info(digest)
+                if blob is None or blob['refs']:
+                    continue
+                if digest in live:
+                    logger.warning("Blob %s is released, but %s refer to it", digest, live[digest])
+                    blob['refs'] = live[digest]
+                    blob.pop('released', None)
+                    self.write(self.key('blobs', digest), blob)
+                    continue
+                if now - blob.get('released', 0) < BLOB_GRACE_PERIOD:
+                    kept.append(digest)
+                    continue
+                logger.info("Removing blob %s", digest)
+                self.remove(self.key('blobs', digest))
+                self.remove_chunks('blobchunks', digest, blob['chunks'])
+        self.write(released_key, kept)
+
+    def stat_app(self, uuid):
+        try:
+            info = self.read_app_info(uuid)
+        except RuntimeError:
+            return None
+
+        if not isinstance(info, dict):
+            # app stored as a single value
+            return {'hash': hashlib.sha1(info).hexdigest(), 'size': len(info), 'blob': info}
+        return {'hash': info.get('hash'), 'size': info['size'], 'blob': info}
+
+    def iter_app(self, uuid, offset=0, length=None, blob=None):
+        info = self.read_app_info(uuid) if blob is None else blob
+        if not isinstance(info, dict):
+            # app stored as a single value
+            return limit_chunks([info], offset, length)
+
+        if info.get('node'):
+            if blob is not None and self.read(self.key('appinfo', uuid)).get('hash') != info['hash']:
+                # the archive stat'ed is overwritten by the upload, unlike blobs
+                raise RuntimeError('App %s is uploaded again' % uuid)
+            start = len(raw_header(info['size']))
+            end = info['size'] if length is None else min(offset + length, info['size'])
+            return self.iter_archive(self.key('apps', uuid), start + offset, start + end)
+
+        if 'hash' in info:
+            blob = self.read_blob_info(info['hash'])
+            if blob is None:
+                raise RuntimeError('Blob %s of app %s is missing' % (info['hash'], uuid))
+            prefix, name, chunks, chunk_size = 'blobchunks', info['hash'], blob['chunks'], blob['chunk_size']
+            raw = blob.get('raw', False)
+        else:
+            prefix, name, chunks, chunk_size = 'appchunks', uuid, info['chunks'], info['chunk_size']
+            raw = False
+
+        # chunks before offset are not read at all
+        first = offset // chunk_size
+        return limit_chunks(self.iter_chunks(prefix, name, chunks, first, raw), offset - first * chunk_size, length)
 
     def delete_app(self, uuid):
-        self.list_remove("system", "list:manifests", uuid)
-        self.remove(self.key('manifests', uuid))
-        self.remove(self.key('apps', uuid))
+        with index_lock:
+            self.list_remove("system", "list:manifests", uuid)
+            self.remove(self.key('manifests', uuid))
+            self.update_summaries(uuid)
+        try:
+            info = self.read_app_info(uuid)
+        except RuntimeError:
+            return
+        self.release_app_blob(uuid, info)
+        self.remove_quietly(self.key('appinfo', uuid))
+        self.remove_quietly(self.key('apps', uuid))
+
+    def remove_quietly(self, key):
+        try:
+            self.remove(key)
+        except RuntimeError:
+            pass
+
+    #=================================================================
+    """
+        Build jobs
+    """
+
+    def create_build(self, job_id, job):
+        self.write_build(job_id, job)
+        self.list_add('system', 'list:builds', job_id)
+
+    def write_build(self, job_id, job):
+        self.write(self.key('builds', job_id), job)
+
+    def read_build(self, job_id, default=None):
+        try:
+            return self.read(self.key('builds', job_id))
+        except RuntimeError:
+            return default
+
+    def clean_builds(self, created_before):
+        try:
+            job_ids = self.read(self.key('system', 'list:builds'), cached=False)
+        except RuntimeError:
+            return
+        jobs = self.remove_prefix('builds', self.bulk_read(self.key('builds', job_ids)))
+
+        kept = []
+        for job_id in job_ids:
+            if job_id not in jobs:
+                continue
+            if unpack_value(jobs[job_id])['created'] >= created_before:
+                kept.append(job_id)
+            else:
+                self.remove_quietly(self.key('builds', job_id))
+        self.write(self.key('system', 'list:builds'), kept)
+        logger.info('Removed %d build records during maintenance', len(job_ids) - len(kept))
 
     #=================================================================
     """
@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import sqlite3
+import threading
+from uuid import uuid4
+from .storage import Storage, DEFAULT_CHUNK_SIZE, as_bytes, manifest_summary, pack_value, unpack_value
+from storages.exceptions import UserExists
+
+
+logger = logging.getLogger('storages.local')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS "values" (key TEXT PRIMARY KEY, value BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT, admin INTEGER, token TEXT);
+CREATE INDEX IF NOT EXISTS users_token ON users (token);
+CREATE TABLE IF NOT EXISTS manifests (uuid TEXT PRIMARY KEY, developer TEXT, runlist TEXT,
+                                      summary BLOB NOT NULL, manifest BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS manifests_developer ON manifests (developer);
+CREATE INDEX IF NOT EXISTS manifests_runlist ON manifests (runlist);
+CREATE TABLE IF NOT EXISTS runlists (name TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS runlist_apps (name TEXT, uuid TEXT, profile TEXT, PRIMARY KEY (name, uuid));
+CREATE INDEX IF NOT EXISTS runlist_apps_uuid ON runlist_apps (uuid);
+CREATE TABLE IF NOT EXISTS profiles (name TEXT PRIMARY KEY, profile BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS aliases (alias TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS hosts (alias TEXT, host TEXT, PRIMARY KEY (alias, host));
+CREATE TABLE IF NOT EXISTS apps (uuid TEXT PRIMARY KEY, hash TEXT NOT NULL, size INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS apps_hash ON apps (hash);
+"""
+
+
+def pack(data, threshold):
+    return buffer(pack_value(data, threshold))
+
+
+def unpack(value):
+    return unpack_value(str(value))
+
+
+class Local(Storage):
+    """
+        Storage in a single sqlite database file, app archives are kept next
+        to it as files named by their sha1, so they are stored once per
+        content and can be memory-mapped
+    """
+
+    def __init__(self, path, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.path = path
+        self.blobs_path = os.path.join(path, 'blobs')
+        self.chunk_size = chunk_size
+        if not os.path.exists(self.blobs_path):
+            os.makedirs(self.blobs_path)
+
+        # connection per thread of every process
+        self.local = threading.local()
+        self.db.executescript(SCHEMA)
+
+    @property
+    def db(self):
+        if getattr(self.local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(os.path.join(self.path, 'storage.db'), timeout=30)
+            connection.text_factory = str
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def key(self, key, *args):
+        prefix = key
+        postfix = args[0]
+
+        if type(postfix) in set([tuple, list, set]):
+            return type(postfix)(["%s\0%s" % (prefix, p) for p in postfix])
+
+        return "%s\0%s" % (prefix, postfix)
+
+    #==================================================================
+    """
+        Plain values
+    """
+
+    def read(self, key):
+        row = self.db.execute('SELECT value FROM "values" WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise RuntimeError('%r is not found' % key)
+        return unpack(row[0])
+
+    def bulk_read(self, keys):
+        """
+            Returns {key: packed value} of existing keys
+        """
+        keys = list(keys)
+        rv = {}
+        # sqlite limits number of query parameters
+        for i in xrange(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            rows = self.db.execute('SELECT key, value FROM "values" WHERE key IN (%s)' % ','.join('?' * len(batch)),
+                                   batch)
+            rv.update((key, str(value)) for key, value in rows)
+        return rv
+
+    def write(self, key, data):
+        with self.db as db:
+            db.execute('INSERT OR REPLACE INTO "values" (key, value) VALUES (?, ?)', (key, pack(data, self.compress_threshold_for(key))))
+
+    def read_raw(self, key):
+        row = self.db.execute('SELECT value FROM "values" WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise RuntimeError('%r is not found' % key)
+        return str(row[0])
+
+    def write_raw(self, key, data):
+        with self.db as db:
+            db.execute('INSERT OR REPLACE INTO "values" (key, value) VALUES (?, ?)', (key, buffer(as_bytes(data))))
+
+    def exists(self, key):
+        return self.db.execute('SELECT 1 FROM "values" WHERE key = ?', (key,)).fetchone() is not None
+
+    def remove(self, key):
+        with self.db as db:
+            if not db.execute('DELETE FROM "values" WHERE key = ?', (key,)).rowcount:
+                raise RuntimeError('%r is not found' % key)
+
+    #==================================================================
+    """
+        Users
+    """
+
+    def user(self, row):
+        if row is None:
+            return None
+        username, password, admin, token = row
+        return {'username': username, 'password': password, 'admin': bool(admin), 'token': token}
+
+    def create_user(self, username, hashed_password, admin, token):
+        try:
+            with self.db as db:
+                db.execute('INSERT INTO users (username, password, admin, token) VALUES (?, ?, ?, ?)',
+                           (username, hashed_password, int(bool(admin)), token))
+        except sqlite3.IntegrityError:
+            raise UserExists
+
+    def find_user_by_username(self, username):
+        return self.user(self.db.execute('SELECT username, password, admin, token FROM users WHERE username = ?',
+                                         (username,)).fetchone())
+
+    def find_user_by_token(self, token):
+        return self.user(self.db.execute('SELECT username, password, admin, token FROM users WHERE token = ?',
+                                         (token,)).fetchone())
+
+    def get_username_by_token(self, token):
+        row = self.db.execute('SELECT username FROM users WHERE token = ?', (token,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_usernames_by_tokens(self, tokens):
+        tokens = list(tokens)
+        rv = {}
+        for i in xrange(0, len(tokens), 500):
+            batch = tokens[i:i + 500]
+            rows = self.db.execute('SELECT token, username FROM users WHERE token IN (%s)' % ','.join('?' * len(batch)),
+                                   batch)
+            rv.update(rows)
+        return rv
+
+    #==================================================================
+    """
+        Manifests
+    """
+
+    def read_manifest(self, uuid, default=None):
+        row = self.db.execute('SELECT manifest FROM manifests WHERE uuid = ?', (uuid,)).fetchone()
+        return unpack(row[0]) if row is not None else default
+
+    def read_manifests(self):
+        return dict((uuid, unpack(manifest)) for uuid, manifest in self.db.execute('SELECT uuid, manifest FROM manifests'))
+
+    def read_manifest_summaries(self, developer=None):
+        if developer is None:
+            rows = self.db.execute('SELECT uuid, summary FROM manifests')
+        else:
+            rows = self.db.execute('SELECT uuid, summary FROM manifests WHERE developer = ?', (developer,))
+        return dict((uuid, unpack(summary)) for uuid, summary in rows)
+
+    def write_manifest(self, uuid, manifest):
+        with self.db as db:
+            db.execute('INSERT OR REPLACE INTO manifests (uuid, developer, runlist, summary, manifest) '
+                       'VALUES (?, ?, ?, ?, ?)',
+                       (uuid, manifest.get('developer'), manifest.get('runlist'),
+                        pack(manifest_summary(manifest), self.compress_threshold),
+                        pack(manifest, self.compress_threshold)))
+
+    #==================================================================
+    """
+        Runlists
+    """
+
+    def read_runlist(self, runlist_name, default=None, cached=True):
+        db = self.db
+        if db.execute('SELECT 1 FROM runlists WHERE name = ?', (runlist_name,)).fetchone() is None:
+            return default
+        return dict(db.execute('SELECT uuid, profile FROM runlist_apps WHERE name = ?', (runlist_name,)))
+
+    def read_runlists(self):
+        runlists = dict((name, {}) for name, in self.db.execute('SELECT name FROM runlists'))
+        for name, uuid, profile in self.db.execute('SELECT name, uuid, profile FROM runlist_apps'):
+            runlists.setdefault(name, {})[uuid] = profile
+        return runlists
+
+    def read_runlist_names(self):
+        return [name for name, in self.db.execute('SELECT name FROM runlists')]
+
+    def write_runlist(self, runlist_name, runlist):
+        with self.db as db:
+            db.execute('INSERT OR IGNORE INTO runlists (name) VALUES (?)', (runlist_name,))
+            db.execute('DELETE FROM runlist_apps WHERE name = ?', (runlist_name,))
+            db.executemany('INSERT INTO runlist_apps (name, uuid, profile) VALUES (?, ?, ?)',
+                           [(runlist_name, uuid, profile) for uuid, profile in runlist.items()])
+
+    def runlist_add(self, runlist_name, uuid, profile):
+        with self.db as db:
+            db.execute('INSERT OR IGNORE INTO runlists (name) VALUES (?)', (runlist_name,))
+            db.execute('INSERT OR REPLACE INTO runlist_apps (name, uuid, profile) VALUES (?, ?, ?)',
+                       (runlist_name, uuid, profile))
+
+    def runlist_remove(self, runlist_name, uuid):
+        with self.db as db:
+            db.execute('DELETE FROM runlist_apps WHERE name = ? AND uuid = ?', (runlist_name, uuid))
+
+    def delete_runlist(self, runlist_name):
+        with self.db as db:
+            db.execute('DELETE FROM runlist_apps WHERE name = ?', (runlist_name,))
+            db.execute('DELETE FROM runlists WHERE name = ?', (runlist_name,))
+
+    def clean_runlists(self):
+        """
+            Removes missing apps from runlists, missing profiles are replaced by `default`
+        """
+        with self.db as db:
+            db.execute('DELETE FROM runlist_apps WHERE uuid NOT IN (SELECT uuid FROM apps)')
+            db.execute("UPDATE runlist_apps SET profile = 'default' WHERE profile NOT IN (SELECT name FROM profiles)")
+
+    #==================================================================
+    """
+        Profiles
+    """
+
+    def read_profile(self, profile_name, default=None):
+        row = self.db.execute('SELECT profile FROM profiles WHERE name = ?', (profile_name,)).fetchone()
+        return unpack(row[0]) if row is not None else default
+
+    def read_profiles(self):
+        return dict((name, unpack(profile)) for name, profile in self.db.execute('SELECT name, profile FROM profiles'))
+
+    def write_profile(self, profile_name, profile):
+        with self.db as db:
+            db.execute('INSERT OR REPLACE INTO profiles (name, profile) VALUES (?, ?)', (profile_name, pack(profile, self.compress_threshold)))
+
+    def delete_profile(self, profile_name):
+        with self.db as db:
+            db.execute('DELETE FROM profiles WHERE name = ?', (profile_name,))
+
+    #==================================================================
+    """
+        Hosts
+    """
+
+    def read_hosts(self):
+        hosts = dict((alias, []) for alias, in self.db.execute('SELECT alias FROM aliases'))
+        for alias, host in self.db.execute('SELECT alias, host FROM hosts ORDER BY rowid'):
+            hosts.setdefault(alias, []).append(host)
+        return hosts
+
+    def write_hosts(self, hosts):
+        with self.db as db:
+            db.execute('DELETE FROM hosts')
+            db.execute('DELETE FROM aliases')
+            db.executemany('INSERT INTO aliases (alias) VALUES (?)', [(alias,) for alias in hosts])
+            db.executemany('INSERT OR IGNORE INTO hosts (alias, host) VALUES (?, ?)',
+                           [(alias, str(host)) for alias, alias_hosts in hosts.items() for host in alias_hosts])
+
+    def add_host(self, alias, host):
+        with self.db as db:
+            db.execute('INSERT OR IGNORE INTO aliases (alias) VALUES (?)', (alias,))
+            db.execute('INSERT OR IGNORE INTO hosts (alias, host) VALUES (?, ?)', (alias, str(host)))
+
+    def delete_host(self, alias, host):
+        with self.db as db:
+            db.execute('DELETE FROM hosts WHERE alias = ? AND host = ?', (alias, host))
+
+    def delete_alias(self, alias):
+        with self.db as db:
+            db.execute('DELETE FROM hosts WHERE alias = ?', (alias,))
+            db.execute('DELETE FROM aliases WHERE alias = ?', (alias,))
+
+    #==================================================================
+    """
+        Apps
+    """
+
+    def blob_path(self, digest):
+        return os.path.join(self.blobs_path, digest[:2], digest)
+
+    @contextmanager
+    def blobs_lock(self):
+        # a blob is published and its last reference is checked under the lock,
+        # so a blob is never removed right after another app started referring to it
+        with open(os.path.join(self.blobs_path, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def save_app(self, uuid, data):
+        """
+            Archive is written to a temporary file while hashed, then renamed
+            to its blob path unless the same content is already stored
+        """
+        h = hashlib.sha1()
+        size = 0
+        tmp = os.path.join(self.blobs_path, '.tmp-%s' % uuid4().hex)
+        try:
+            with open(tmp, 'wb') as f:
+                while True:
+                    chunk = data.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+                os.fsync(f.fileno())
+
+            digest = h.hexdigest()
+            path = self.blob_path(digest)
+            with self.blobs_lock():
+                if not os.path.exists(path):
+                    if not os.path.exists(os.path.dirname(path)):
+                        os.makedirs(os.path.dirname(path))
+                    os.rename(tmp, path)
+
+                with self.db as db:
+                    row = db.execute('SELECT hash FROM apps WHERE uuid = ?', (uuid,)).fetchone()
+                    db.execute('INSERT OR REPLACE INTO apps (uuid, hash, size) VALUES (?, ?, ?)', (uuid, digest, size))
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+        if row is not None and row[0] != digest:
+            self.release_blob(row[0])
+
+    def release_blob(self, digest):
+        with self.blobs_lock():
+            if self.db.execute('SELECT 1 FROM apps WHERE hash = ? LIMIT 1', (digest,)).fetchone() is not None:
+                return
+            logger.info("Removing blob %s", digest)
+            try:
+                os.unlink(self.blob_path(digest))
+            except OSError:
+                pass
+
+    def stat_app(self, uuid):
+        row = self.db.execute('SELECT hash, size FROM apps WHERE uuid = ?', (uuid,)).fetchone()
+        if row is None:
+            return None
+        return {'hash': row[0], 'size': row[1], 'blob': row}
+
+    def iter_app(self, uuid, offset=0, length=None, blob=None):
+        if blob is None:
+            blob = self.db.execute('SELECT hash, size FROM apps WHERE uuid = ?', (uuid,)).fetchone()
+            if blob is None:
+                raise RuntimeError('App %s is not found' % uuid)
+        digest, size = blob
+        end = size if length is None else min(offset + length, size)
+        return self.iter_blob(digest, offset, end)
+
+    def iter_blob(self, digest, start, end):
+        # opened before streaming starts, so the blob stays readable even
+        # if it is released meanwhile
+        with open(self.blob_path(digest), 'rb') as f:
+            if start >= end:
+                return iter([])
+            blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.iter_mapped(blob, start, end)
+
+    def iter_mapped(self, blob, start, end):
+        try:
+            for position in xrange(start, end, self.chunk_size):
+                yield blob[position:min(position + self.chunk_size, end)]
+        finally:
+            blob.close()
+
+    def delete_app(self, uuid):
+        with self.db as db:
+            row = db.execute('SELECT hash FROM apps WHERE uuid = ?', (uuid,)).fetchone()
+            db.execute('DELETE FROM apps WHERE uuid = ?', (uuid,))
+            db.execute('DELETE FROM manifests WHERE uuid = ?', (uuid,))
+        if row is not None:
+            self.release_blob(row[0])
+
+    #==================================================================
+    """
+        Build jobs
+    """
+
+    def write_build(self, job_id, job):
+        self.write(self.key('builds', job_id), job)
+
+    def read_build(self, job_id, default=None):
+        try:
+            return self.read(self.key('builds', job_id))
+        except RuntimeError:
+            return default
+
+    def clean_builds(self, created_before):
+        rows = self.db.execute('SELECT key, value FROM "values" WHERE key >= ? AND key < ?',
+                               ('builds\0', 'builds\1')).fetchall()
+        expired = [(key, ) for key, value in rows if unpack(value)['created'] < created_before]
+        with self.db as db:
+            db.executemany('DELETE FROM "values" WHERE key = ?', expired)
+
+    def write_recipes(self, host, data):
+        pass
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import threading
+from .elliptics import Elliptics
+from .storage import DEFAULT_CHUNK_SIZE, as_bytes
+
+
+class MemorySession(object):
+    """
+        Process local dict with the interface of elliptics session
+        used by Elliptics storage: missed keys raise RuntimeError
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def read(self, key):
+        try:
+            return self.data[key]
+        except KeyError:
+            raise RuntimeError('%r is not found' % key)
+
+    def read_data(self, key, offset=0, size=0):
+        value = self.read(key)
+        if offset or size:
+            return value[offset:offset + size if size else None]
+        return value
+
+    def bulk_read(self, keys):
+        data = self.data
+        return dict((key, data[key]) for key in keys if key in data)
+
+    def write(self, key, data, *args, **kwargs):
+        self.data[key] = as_bytes(data)
+
+    def write_data(self, key, data, offset=0, *args, **kwargs):
+        data = as_bytes(data)
+        if offset:
+            # like elliptics, the rest of value is kept
+            with self.lock:
+                value = self.data.get(key, '')
+                data = value[:offset].ljust(offset, '\0') + data + value[offset + len(data):]
+                self.data[key] = data
+            return
+        self.data[key] = data
+
+    def remove(self, key, *args, **kwargs):
+        with self.lock:
+            try:
+                del self.data[key]
+            except KeyError:
+                raise RuntimeError('%r is not found' % key)
+
+    def add_groups(self, groups):
+        pass
+
+
+class Memory(Elliptics):
+    """
+        Reference storage keeping everything in memory of the process,
+        with the same layout as Elliptics storage.
+
+        Nothing is shared between processes or kept across restarts,
+        so it fits tests, benchmarks and single process development
+        servers only.
+    """
+
+    # there are no nodes to read archives from memory of the process
+    node_archives = False
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, session=None, node_archives=False):
+        self.chunk_size = chunk_size
+        self.node_archives = node_archives
+        self.storage = session if session is not None else MemorySession()
@@ -1,13 +1,99 @@
 # -*- coding: utf-8 -*-
+from time import time
+from bson.binary import Binary
+from gridfs import GridFS
+from gridfs.errors import NoFile
 from pymongo.errors import DuplicateKeyError
 from flask.ext.pymongo import PyMongo
-from .storage import Storage
+from .storage import Storage, BLOB_GRACE_PERIOD, as_bytes, file_digest, limit_chunks, pack_value, unpack_value, SUMMARY_FIELDS
 from storages.exceptions import UserExists
 
+# collection: indexed fields
+INDEXES = {
+    'users': ['token'],
+    'manifests': ['developer', 'runlist'],
+    'runlists': ['apps.uuid'],
+    'hosts': ['alias'],
+}
+
+
 class Mongo(Storage):
     def __init__(self, app):
         self.app = app
         self.mongo = PyMongo(self.app)
+        with self.app.app_context():
+            for collection, fields in INDEXES.items():
+                for field in fields:
+                    self.mongo.db[collection].ensure_index(field)
+
+    #==================================================================
+    """
+        Plain values, stored packed like in other storages
+    """
+
+    def read(self, key):
+        def load():
+            record = self.mongo.db.values.find_one({'_id': key})
+            if record is None:
+                raise RuntimeError('%r is not found' % key)
+            return unpack_value(record['value'])
+
+        return self.cached(key, load)
+
+    def bulk_read(self, keys):
+        """
+            Returns {key: packed value} of existing keys
+        """
+        return dict((record['_id'], str(record['value']))
+                    for record in self.mongo.db.values.find({'_id': {'$in': list(keys)}}))
+
+    def write(self, key, data):
+        try:
+            return self.mongo.db.values.update({'_id': key}, {'_id': key, 'value': Binary(pack_value(data, self.compress_threshold_for(key)))},
+                                               upsert=True)
+        finally:
+            self.invalidate(key)
+
+    def read_raw(self, key):
+        record = self.mongo.db.values.find_one({'_id': key})
+        if record is None:
+            raise RuntimeError('%r is not found' % key)
+        return str(record['value'])
+
+    def write_raw(self, key, data):
+        try:
+            return self.mongo.db.values.update({'_id': key}, {'_id': key, 'value': Binary(as_bytes(data))},
+                                               upsert=True)
+        finally:
+            self.invalidate(key)
+
+    def exists(self, key):
+        return self.mongo.db.values.find_one({'_id': key}, fields=['_id']) is not None
+
+    def remove(self, key):
+        try:
+            return self.mongo.db.values.remove({'_id': key})
+        finally:
+            self.invalidate(key)
+
+    def key(self, key, *args):
+        prefix = key
+        postfix = args[0]
+
+        if type(postfix) in set([tuple, list, set]):
+            return type(postfix)(["%s\0%s" % (prefix, p) for p in postfix])
+
+        return "%s\0%s" % (prefix, postfix)
+
+    #==================================================================
+    """
+        Users
+    """
+
+    def user(self, record):
+        if record is not None:
+            record['username'] = record['_id']
+        return record
 
     def create_user(self, username, hashed_password, admin, token):
         try:
@@ -18,42 +104,144 @@ class Mongo(Storage):
             raise UserExists
 
     def find_user_by_token(self, token):
-        return self.mongo.db.users.find_one({'token': token})
+        return self.user(self.mongo.db.users.find_one({'token': token}))
 
     def find_user_by_username(self, username):
-        return self.mongo.db.users.find_one({'_id': username})
+        return self.user(self.mongo.db.users.find_one({'_id': username}))
 
-    def key(self, key, *args):
-        prefix = key
-        postfix = args[0]
+    def get_username_by_token(self, token):
+        user = self.mongo.db.users.find_one({'token': token}, fields=['_id'])
+        return user['_id'] if user is not None else None
 
-        if type(postfix) in set([tuple, list, set]):
-            return type(postfix)(["%s\0%s" % (prefix, p) for p in postfix])
+    def get_usernames_by_tokens(self, tokens):
+        users = self.mongo.db.users.find({'token': {'$in': list(tokens)}}, fields=['token'])
+        return dict((user['token'], user['_id']) for user in users)
 
-        return "%s\0%s" % (prefix, postfix)
+    #==================================================================
+    """
+        Manifests
+    """
+
+    def invalidate_manifest(self, uuid, developer=None):
+        self.invalidate(self.key('manifests', uuid), self.key('system', 'list:manifests'),
+                        self.summaries_key(), self.summaries_key(developer))
 
     def read_manifest(self, uuid, default=None):
-        return self.mongo.db.manifests.find_one({'uuid': uuid}) or default
+        return self.cached(self.key('manifests', uuid),
+                           lambda: self.mongo.db.manifests.find_one({'_id': uuid})) or default
 
     def read_manifests(self):
-        return dict([(manifest['_id'], manifest) for manifest in self.mongo.db.manifests.find()])
+        return self.cached(self.key('system', 'list:manifests'),
+                           lambda: dict([(manifest['_id'], manifest) for manifest in self.mongo.db.manifests.find()]))
+
+    def summaries_key(self, developer=None):
+        if developer is None:
+            return self.key('system', 'index:manifests')
+        return self.key('system', 'index:manifests:%s' % developer)
+
+    def read_manifest_summaries(self, developer=None):
+        spec = {} if developer is None else {'developer': developer}
+        return self.cached(self.summaries_key(developer),
+                           lambda: dict([(manifest['_id'], manifest)
+                                         for manifest in self.mongo.db.manifests.find(spec, fields=SUMMARY_FIELDS)]),
+                           copy=False)
 
     def write_manifest(self, uuid, manifest):
-        return self.mongo.db.manifests.update({'_id': uuid}, manifest, upsert=True)
+        try:
+            return self.mongo.db.manifests.update({'_id': uuid}, manifest, upsert=True)
+        finally:
+            self.invalidate_manifest(uuid, manifest.get('developer'))
+
+    #==================================================================
+    """
+        Runlists are stored as {'_id': name, 'apps': [{'uuid': app uuid, 'profile': profile name}]},
+        as app uuids contain dots, which can't be used in field names
+    """
+
+    def runlist(self, record):
+        return dict((app['uuid'], app['profile']) for app in record.get('apps', []))
+
+    def invalidate_runlist(self, runlist_name):
+        self.invalidate(self.key('runlists', runlist_name), self.key('system', 'list:runlists'))
 
     def write_runlist(self, runlist_name, runlist):
-        return self.mongo.db.manifests.update({'_id': runlist_name}, runlist, upsert=True)
+        apps = [{'uuid': uuid, 'profile': profile} for uuid, profile in runlist.items()]
+        try:
+            return self.mongo.db.runlists.update({'_id': runlist_name}, {'$set': {'apps': apps}}, upsert=True)
+        finally:
+            self.invalidate_runlist(runlist_name)
+
+    def runlist_add(self, runlist_name, uuid, profile):
+        try:
+            self.mongo.db.runlists.update({'_id': runlist_name}, {'$pull': {'apps': {'uuid': uuid}}}, upsert=True)
+            self.mongo.db.runlists.update({'_id': runlist_name},
+                                          {'$push': {'apps': {'uuid': uuid, 'profile': profile}}})
+        finally:
+            self.invalidate_runlist(runlist_name)
+
+    def runlist_remove(self, runlist_name, uuid):
+        try:
+            self.mongo.db.runlists.update({'_id': runlist_name}, {'$pull': {'apps': {'uuid': uuid}}})
+        finally:
+            self.invalidate_runlist(runlist_name)
 
     def read_runlists(self):
-        return dict([(runlist['_id'], runlist) for runlist in self.mongo.db.runlists.find()])
+        return self.cached(self.key('system', 'list:runlists'),
+                           lambda: dict([(runlist['_id'], self.runlist(runlist))
+                                         for runlist in self.mongo.db.runlists.find()]), copy=False)
+
+    def read_runlist_names(self):
+        return [runlist['_id'] for runlist in self.mongo.db.runlists.find(fields=['_id'])]
+
+    def read_runlist(self, runlist_name, default=None, cached=True):
+        def load():
+            record = self.mongo.db.runlists.find_one({'_id': runlist_name})
+            return self.runlist(record) if record is not None else None
+
+        rv = self.cached(self.key('runlists', runlist_name), load) if cached else load()
+        return rv if rv is not None else default
+
+    def delete_runlist(self, runlist_name):
+        try:
+            self.mongo.db.runlists.remove({'_id': runlist_name})
+        finally:
+            self.invalidate_runlist(runlist_name)
+
+    def clean_runlists(self):
+        """
+            Removes missing apps from runlists, missing profiles are replaced by `default`
+        """
+        uuids = set(manifest['_id'] for manifest in self.mongo.db.manifests.find(fields=['_id']))
+        profiles = set(profile['_id'] for profile in self.mongo.db.profiles.find(fields=['_id']))
+
+        bulk = self.mongo.db.runlists.initialize_unordered_bulk_op()
+        changed = False
+        for record in self.mongo.db.runlists.find():
+            apps = [{'uuid': app['uuid'], 'profile': app['profile'] if app['profile'] in profiles else 'default'}
+                    for app in record.get('apps', []) if app['uuid'] in uuids]
+            if apps != record.get('apps', []):
+                bulk.find({'_id': record['_id']}).upsert().update({'$set': {'apps': apps}})
+                self.invalidate_runlist(record['_id'])
+                changed = True
+        if changed:
+            bulk.execute()
+
+    #==================================================================
+    """
+        Profiles
+    """
 
-    def read_runlist(self, runlist_name, default=None):
-        return self.mongo.db.runlists.find_one({'_id': runlist_name}) or default
+    def invalidate_profile(self, profile_name):
+        self.invalidate(self.key('profiles', profile_name), self.key('system', 'list:profiles'))
 
     def read_profile(self, profile_name, default=None):
-        return self.mongo.db.profiles.find_one({'_id': profile_name}) or default
+        return self.cached(self.key('profiles', profile_name),
+                           lambda: self.mongo.db.profiles.find_one({'_id': profile_name})) or default
 
     def read_profiles(self):
+        return self.cached(self.key('system', 'list:profiles'), self._read_profiles, copy=False)
+
+    def _read_profiles(self):
         rv = {}
         for profile in self.mongo.db.profiles.find():
             _id = profile.pop('_id')
@@ -62,34 +250,179 @@ class Mongo(Storage):
 
     def write_profile(self, profile_name, profile):
         profile['_id'] = profile_name
-        return self.mongo.db.profiles.update({'_id': profile_name}, profile, upsert=True)
+        try:
+            return self.mongo.db.profiles.update({'_id': profile_name}, profile, upsert=True)
+        finally:
+            self.invalidate_profile(profile_name)
+
+    def delete_profile(self, profile_name):
+        try:
+            self.mongo.db.profiles.remove({'_id': profile_name})
+        finally:
+            self.invalidate_profile(profile_name)
+
+    #==================================================================
+    """
+        Hosts are stored as {'alias': alias, 'hosts': [host]}
+    """
+
+    def invalidate_hosts(self):
+        self.invalidate(self.key('system', 'list:hosts'))
 
     def read_hosts(self):
+        return self.cached(self.key('system', 'list:hosts'), self._read_hosts, copy=False)
+
+    def _read_hosts(self):
         hosts = {}
-        try:
-            for record in self.mongo.db.hosts.find():
-                hosts[record['alias']] = record['hosts']
-        except RuntimeError:
-            pass
+        for record in self.mongo.db.hosts.find(fields=['alias', 'hosts']):
+            # duplicates of an alias might have been inserted by older versions
+            alias_hosts = hosts.setdefault(record['alias'], [])
+            alias_hosts.extend(host for host in record['hosts'] if host not in alias_hosts)
         return hosts
 
+    def write_hosts(self, hosts):
+        try:
+            bulk = self.mongo.db.hosts.initialize_unordered_bulk_op()
+            bulk.find({'alias': {'$nin': hosts.keys()}}).remove()
+            for alias, alias_hosts in hosts.items():
+                bulk.find({'alias': alias}).upsert().update({'$set': {'hosts': list(alias_hosts)}})
+            bulk.execute()
+        finally:
+            self.invalidate_hosts()
+
     def add_host(self, alias, host):
-        record = self.mongo.db.hosts.find_one({'alias': alias})
-        if record is None:
-            return self.mongo.db.hosts.insert({'alias': alias, 'hosts': [host]})
+        try:
+            return self.mongo.db.hosts.update({'alias': alias}, {'$addToSet': {'hosts': str(host)}}, upsert=True)
+        finally:
+            self.invalidate_hosts()
+
+    def delete_host(self, alias, host):
+        try:
+            return self.mongo.db.hosts.update({'alias': alias}, {'$pull': {'hosts': host}}, multi=True)
+        finally:
+            self.invalidate_hosts()
+
+    def delete_alias(self, alias):
+        try:
+            return self.mongo.db.hosts.remove({'alias': alias})
+        finally:
+            self.invalidate_hosts()
 
-        if host in record['hosts']:
-            return
+    def clean_hosts(self):
+        try:
+            self.mongo.db.hosts.remove({'$or': [{'alias': {'$exists': False}}, {'hosts': {'$exists': False}}]})
+        finally:
+            self.invalidate_hosts()
 
-        record['hosts'].append(host)
-        return self.mongo.db.hosts.insert(record)
+    #==================================================================
+    """
+        Apps
+    """
 
     def save_app(self, uuid, fileobj):
-        self.mongo.save_file(self.key("apps", uuid), fileobj)
+        """
+            Archives are stored in GridFS once per content as `blobs\0<sha1>`,
+            `apps` collection maps app uuid to the hash and `blobs` collection
+            keeps the apps referring to every blob. Blobs left without refs are
+            removed by clean_apps after BLOB_GRACE_PERIOD
+        """
+        digest, size = file_digest(fileobj)
+        filename = self.key("blobs", digest)
+        # referring the blob first keeps clean_apps off it
+        blob = self.mongo.db.blobs.find_and_modify({'_id': digest},
+                                                   {'$addToSet': {'refs': uuid},
+                                                    '$unset': {'released': True, 'removing': True}},
+                                                   upsert=True)
+        try:
+            # files of a blob being removed are gone or about to be
+            if (blob is not None and 'removing' in blob) or not GridFS(self.mongo.db).exists(filename=filename):
+                self.mongo.save_file(filename, fileobj)
+        except Exception:
+            self.release_blob(uuid, digest)
+            raise
+
+        previous = self.mongo.db.apps.find_and_modify({'_id': uuid}, {'_id': uuid, 'hash': digest, 'size': size},
+                                                      upsert=True)
+        if previous is not None and previous['hash'] != digest:
+            self.release_blob(uuid, previous['hash'])
+
+    def release_blob(self, uuid, digest):
+        self.mongo.db.blobs.update({'_id': digest}, {'$pull': {'refs': uuid}})
+        self.mongo.db.blobs.update({'_id': digest, 'refs': [], 'released': {'$exists': False}},
+                                   {'$set': {'released': time()}})
+
+    def clean_apps(self):
+        """
+            Removes blobs released more than BLOB_GRACE_PERIOD ago, unless
+            an upload has referred them again
+        """
+        fs = GridFS(self.mongo.db)
+        cutoff = time() - BLOB_GRACE_PERIOD
+        for blob in self.mongo.db.blobs.find({'refs': [], 'released': {'$lt': cutoff}}, fields=['_id']):
+            digest = blob['_id']
+            filename = self.key("blobs", digest)
+            # files saved after the blob is marked are not ours to remove
+            files = [f['_id'] for f in self.mongo.db.fs.files.find({'filename': filename}, fields=['_id'])]
+            marked = self.mongo.db.blobs.find_and_modify({'_id': digest, 'refs': [], 'released': {'$lt': cutoff}},
+                                                         {'$set': {'removing': time()}})
+            if marked is None:
+                continue
+            for file_id in files:
+                fs.delete(file_id)
+            self.mongo.db.blobs.remove({'_id': digest, 'refs': [], 'removing': {'$exists': True}})
+
+    def app_filename(self, uuid):
+        info = self.mongo.db.apps.find_one({'_id': uuid})
+        if info is not None:
+            return self.key("blobs", info['hash']), info
+        # app stored before deduplication
+        return self.key("apps", uuid), None
+
+    def stat_app(self, uuid):
+        filename, info = self.app_filename(uuid)
+        if info is not None:
+            return {'hash': info['hash'], 'size': info['size'], 'blob': filename}
+
+        try:
+            app = GridFS(self.mongo.db).get_last_version(filename)
+        except NoFile:
+            return None
+        return {'hash': None, 'size': app.length, 'blob': app._id}
+
+    def iter_app(self, uuid, offset=0, length=None, blob=None):
+        if blob is None:
+            blob, info = self.app_filename(uuid)
+        if isinstance(blob, basestring):
+            app = GridFS(self.mongo.db).get_last_version(blob)
+        else:
+            # the very version of a file stored before deduplication
+            app = GridFS(self.mongo.db).get(blob)
+        app.seek(offset)
+        return limit_chunks(iter(lambda: app.read(app.chunk_size), ''), 0, length)
+
+    def delete_app(self, uuid):
+        info = self.mongo.db.apps.find_and_modify({'_id': uuid}, remove=True)
+        if info is not None:
+            self.release_blob(uuid, info['hash'])
+        else:
+            self.mongo.remove_file(self.key("apps", uuid))
+        manifest = self.mongo.db.manifests.find_and_modify({'_id': uuid}, remove=True) or {}
+        self.invalidate_manifest(uuid, manifest.get('developer'))
+
+    #==================================================================
+    """
+        Build jobs
+    """
+
+    def write_build(self, job_id, job):
+        job = dict(job, _id=job_id)
+        return self.mongo.db.builds.update({'_id': job_id}, job, upsert=True)
+
+    def read_build(self, job_id, default=None):
+        return self.mongo.db.builds.find_one({'_id': job_id}) or default
 
-    def remove_app(self, uuid):
-        self.mongo.remove_file(self.key("apps", uuid))
-        self.mongo.db.manifests.remove({'uuid': uuid})
+    def clean_builds(self, created_before):
+        self.mongo.db.builds.remove({'created': {'$lt': created_before}})
 
-    def clean_manifests(self):
+    def write_recipes(self, host, data):
         pass
@@ -1,22 +1,131 @@
 # -*- coding: utf-8 -*-
+from copy import deepcopy
+import hashlib
+import zlib
 import msgpack
 
-def serialize(func):
+# apps are stored and read by chunks of this size
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+# blobs left without apps are removed by maintenance this many seconds after
+BLOB_GRACE_PERIOD = 3600
+
+# structured values packed to this many bytes or more are compressed, 0 disables compression
+DEFAULT_COMPRESS_THRESHOLD = 8192
+COMPRESS_LEVEL = 1
+# keys which only cocaine-flow reads (`\0` written as `:`), manifests, runlists,
+# profiles and apps are read by cocaine nodes as plain msgpack and never compressed
+DEFAULT_COMPRESS_PREFIXES = ('system:index', 'system:list:balances', 'builds')
+# compressed values start with 0xc1, which msgpack never uses, and id of the codec
+COMPRESSED = '\xc1'
+ZLIB = 'z'
+
+# manifest fields shown by app lists, big ones like structure and changelog are left out
+SUMMARY_FIELDS = ('uuid', 'name', 'type', 'description', 'developer', 'ref', 'runlist', 'url',
+                  'depends', 'drivers', 'args')
+
+
+def manifest_summary(manifest):
+    return dict((field, manifest[field]) for field in SUMMARY_FIELDS if field in manifest)
+
+
+def as_bytes(data):
+    """
+        Returns str of str, buffer, bytearray or memoryview `data`,
+        copying it only when it is not str already
+    """
+    if isinstance(data, str):
+        return data
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return str(data)
+
+
+def file_digest(fileobj, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+        Returns (sha1 hex digest, size) of file object and rewinds it
+    """
+    h = hashlib.sha1()
+    size = 0
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        h.update(chunk)
+        size += len(chunk)
+    fileobj.seek(0)
+    return h.hexdigest(), size
+
+
+def limit_chunks(chunks, skip=0, length=None):
+    """
+        Yields `length` bytes (all if None) of `chunks` following first `skip` bytes
+    """
+    for chunk in chunks:
+        if skip:
+            if skip >= len(chunk):
+                skip -= len(chunk)
+                continue
+            chunk, skip = chunk[skip:], 0
+
+        if length is not None:
+            if len(chunk) >= length:
+                if length:
+                    yield chunk[:length]
+                return
+            length -= len(chunk)
+
+        yield chunk
+
+
+def pack_value(data, threshold=DEFAULT_COMPRESS_THRESHOLD):
+    """
+        Returns msgpack of `data`, compressed if it takes `threshold` bytes or more
+    """
+    packed = msgpack.packb(data)
+    if threshold and len(packed) >= threshold:
+        compressed = COMPRESSED + ZLIB + zlib.compress(packed, COMPRESS_LEVEL)
+        if len(compressed) < len(packed):
+            return compressed
+    return packed
+
+
+def unpack_value(value, **kwargs):
+    """
+        Unpacks a value written by pack_value, values written before
+        compression was introduced are plain msgpack
+    """
+    if value[:1] == COMPRESSED:
+        if value[1:2] != ZLIB:
+            raise ValueError('Unknown codec %r of compressed value' % value[1:2])
+        value = zlib.decompress(value[2:])
+    return msgpack.unpackb(value, **kwargs)
+
+
+def key_has_prefix(key, prefixes):
+    name = key.replace('\0', ':')
+    return any(name == prefix or name.startswith(prefix + ':') for prefix in prefixes)
+
+
+def serialize(func, threshold_for=lambda key: DEFAULT_COMPRESS_THRESHOLD):
     def wrapper(key, data, *args, **kwargs):
-        return func(key, msgpack.packb(data), *args, **kwargs)
+        return func(key, pack_value(data, threshold_for(key)), *args, **kwargs)
 
     return wrapper
 
 
 def deserialize(func):
     def wrapper(*args, **kwargs):
-        return msgpack.unpackb(func(*args, **kwargs))
+        return unpack_value(func(*args, **kwargs))
 
     return wrapper
 
 
 class Storage(object):
     storage = None
+    cache = None
+    compress_threshold = DEFAULT_COMPRESS_THRESHOLD
+    compress_prefixes = DEFAULT_COMPRESS_PREFIXES
     deserialize_methods = set(['read', 'read_data'])
     serialize_methods = set(['write', 'write_data'])
 
@@ -25,13 +134,60 @@ class Storage(object):
             return deserialize(getattr(self.storage, item))
 
         if item in self.serialize_methods:
-            return serialize(getattr(self.storage, item))
+            return serialize(getattr(self.storage, item), self.compress_threshold_for)
 
         return getattr(self.storage, item)
 
     def key(self, prefix, postfix):
         raise NotImplemented
 
+    def set_cache(self, cache):
+        self.cache = cache
+
+    def set_compression(self, threshold, prefixes=DEFAULT_COMPRESS_PREFIXES):
+        self.compress_threshold = threshold
+        self.compress_prefixes = tuple(prefixes)
+
+    def compress_threshold_for(self, key):
+        """
+            Values of keys read by cocaine nodes are never compressed
+        """
+        return self.compress_threshold if key_has_prefix(key, self.compress_prefixes) else 0
+
+    def cached(self, key, load, copy=True):
+        """
+            Returns result of `load()` cached by storage `key`. A copy is returned,
+            so callers are free to modify it, unless `copy` is False
+        """
+        if self.cache is None:
+            return load()
+        value = self.cache.fetch(key, load)
+        return deepcopy(value) if copy else value
+
+    def invalidate(self, *keys):
+        if self.cache is not None:
+            self.cache.invalidate(*keys)
+
+    def read_raw(self, key):
+        """
+            Returns bytes stored by `key` as is, without msgpack,
+            raises RuntimeError if the key is missed
+        """
+        return self.storage.read_data(key)
+
+    def write_raw(self, key, data):
+        """
+            Stores str, buffer or memoryview `data` by `key` as is, without msgpack
+        """
+        return self.storage.write_data(key, as_bytes(data))
+
+    def exists(self, key):
+        try:
+            self.read_raw(key)
+        except RuntimeError:
+            return False
+        return True
+
     def create_user(self, username, hashed_password, admin, token):
         raise NotImplementedError
 
@@ -44,16 +200,53 @@ class Storage(object):
     def get_username_by_token(self, token):
         raise NotImplementedError
 
+    def get_usernames_by_tokens(self, tokens):
+        """
+            Returns {token: username} of known `tokens`
+        """
+        raise NotImplementedError
+
     def read_manifest(self, uuid):
         raise NotImplementedError
 
     def read_manifests(self):
         raise NotImplementedError
 
+    # lists below may be shared by callers through the read cache,
+    # they are never modified
+
+    def read_manifest_summaries(self):
+        """
+            Returns {uuid: manifest summary} of all apps
+        """
+        raise NotImplementedError
+
     def read_runlists(self):
         raise NotImplementedError
 
-    def read_runlist(self, runlist_name, default=None):
+    def read_runlist(self, runlist_name, default=None, cached=True):
+        """
+            `cached` False reads past the read cache, for runlists about to be modified
+        """
+        raise NotImplementedError
+
+    def read_runlist_names(self):
+        return self.read_runlists().keys()
+
+    def write_runlist(self, runlist_name, runlist):
+        raise NotImplementedError
+
+    def runlist_add(self, runlist_name, uuid, profile):
+        runlist = self.read_runlist(runlist_name, {}, cached=False)
+        runlist[uuid] = profile
+        self.write_runlist(runlist_name, runlist)
+
+    def runlist_remove(self, runlist_name, uuid):
+        runlist = self.read_runlist(runlist_name, {}, cached=False)
+        if runlist.pop(uuid, None) is not None:
+            self.write_runlist(runlist_name, runlist)
+
+    def delete_runlist(self, runlist_name):
         raise NotImplementedError
 
     def read_profile(self, profile_name, default=None):
@@ -68,12 +261,69 @@ class Storage(object):
     def write_profile(self, profile_name, profile):
         raise NotImplementedError
 
+    def delete_profile(self, profile_name):
+        raise NotImplementedError
+
+    def write_hosts(self, hosts):
+        raise NotImplementedError
+
+    def add_host(self, alias, host):
+        raise NotImplementedError
+
+    def delete_host(self, alias, host):
+        raise NotImplementedError
+
+    def delete_alias(self, alias):
+        raise NotImplementedError
+
+    def save_app(self, uuid, data):
+        raise NotImplementedError
+
+    def stat_app(self, uuid):
+        """
+            Returns {'hash': sha1 of archive or None, 'size': bytes, 'blob': reference
+            of the archive for iter_app} of app archive or None if there is no such app
+        """
+        raise NotImplementedError
+
+    def iter_app(self, uuid, offset=0, length=None, blob=None):
+        """
+            Yields `length` bytes (whole rest if None) of app archive
+            starting from `offset` by chunks. Archive referred by `blob` from
+            stat_app is streamed if given, even if the app was uploaded again
+        """
+        raise NotImplementedError
+
+    def delete_app(self, uuid):
+        raise NotImplementedError
+
+    def create_build(self, job_id, job):
+        """
+            Stores a new job, its updates are written by write_build
+        """
+        self.write_build(job_id, job)
+
+    def write_build(self, job_id, job):
+        raise NotImplementedError
+
+    def read_build(self, job_id, default=None):
+        raise NotImplementedError
+
+    def clean_builds(self, created_before):
+        """
+            Removes records of build jobs created before `created_before` timestamp
+        """
+        pass
+
     def clean_manifests(self):
         pass
 
     def clean_runlists(self):
         pass
 
+    def clean_apps(self):
+        pass
+
     def clean_profiles(self):
         pass
 
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from copy import deepcopy
+from cocaine.flow.storages import storage
+from cocaine.flow.storages.cache import ReadCache
+
+
+DEFAULT_TTL = 30
+DEFAULT_SIZE = 10000
+DEFAULT_UNKNOWN_TTL = 5
+DEFAULT_UNKNOWN_SIZE = 1000
+
+
+class UnknownToken(Exception):
+    pass
+
+
+class UserCache(object):
+    """
+        Token -> user cache of authentication decorators. Unknown tokens are
+        remembered too, in a separate smaller LRU, so requests with random
+        tokens can't push known users out of the cache.
+    """
+
+    def __init__(self):
+        self.configure()
+
+    def configure(self, ttl=DEFAULT_TTL, size=DEFAULT_SIZE,
+                  unknown_ttl=DEFAULT_UNKNOWN_TTL, unknown_size=DEFAULT_UNKNOWN_SIZE):
+        self.users = ReadCache(size, ttl)
+        self.unknown = ReadCache(unknown_size, unknown_ttl)
+
+    def load(self, token):
+        user = storage.find_user_by_token(token)
+        if user is None:
+            raise UnknownToken(token)
+        return user
+
+    def find_user_by_token(self, token):
+        key = 'tokens\0%s' % token
+        if self.unknown.get(key):
+            return None
+
+        # taken before the lookup, so an invalidation meanwhile isn't undone
+        generation = self.unknown.generation
+        try:
+            return deepcopy(self.users.fetch(key, lambda: self.load(token)))
+        except UnknownToken:
+            ttl = self.unknown.ttl_for(key)
+            if ttl:
+                self.unknown.put(key, True, ttl, generation)
+            return None
+
+    def invalidate(self, token=None):
+        """
+            Forgets `token` or all tokens if None
+        """
+        if token is None:
+            self.users.clear()
+            self.unknown.clear()
+        else:
+            key = 'tokens\0%s' % token
+            self.users.invalidate(key)
+            self.unknown.invalidate(key)
+
+
+user_cache = UserCache()
+
+
+def init_user_cache(app):
+    user_cache.configure(app.config.get('TOKEN_CACHE_TTL', DEFAULT_TTL),
+                         app.config.get('TOKEN_CACHE_SIZE', DEFAULT_SIZE),
+                         app.config.get('TOKEN_CACHE_UNKNOWN_TTL', DEFAULT_UNKNOWN_TTL),
+                         app.config.get('TOKEN_CACHE_UNKNOWN_SIZE', DEFAULT_UNKNOWN_SIZE))
@@ -1,18 +1,20 @@
 # -*- coding: utf-8 -*-
 from flask import render_template, request
 from flask.helpers import json
+from cocaine.flow.builds import builds
 from cocaine.flow.storages import storage
 from views import token_required, logged_in
-from cocaine.flow.common import add_prefix
 
 
 @token_required(admin=True)
 def maintenance(user):
     s = storage
     s.clean_manifests()
+    s.clean_apps()
     s.clean_profiles()
     s.clean_runlists()
     s.clean_hosts()
+    builds.clean()
     return 'ok'
 
 
@@ -100,10 +102,9 @@ def add_balance_list(group, app_name, user):
         except ValueError:
             return 'Values of dict should be ints', 400
 
-    try:
-        s.bulk_read(add_prefix("apps", post_body.keys()))
-    except RuntimeError:
-        return "One of app's version is not uploaded"
+    # bulk_read skips missed keys, so versions are checked one by one
+    if any(s.stat_app(uuid) is None for uuid in post_body):
+        return "One of app's version is not uploaded", 400
 
     balances.setdefault(app_name, {})
     balances[app_name]['AppVersions'] = post_body
@@ -1,9 +1,7 @@
 # -*- coding: utf-8 -*-
-from time import time, sleep
 from flask import request, current_app, flash, redirect, session, url_for, jsonify
-import msgpack
-import zmq
-from storages import storage
+from cocaine.flow.rpc import send_json_rpc, iter_json_rpc
+from cocaine.flow.usercache import user_cache
 
 
 def token_required(admin=False):
@@ -14,7 +12,7 @@ def token_required(admin=False):
             if not token:
                 return 'Token is required', 403
 
-            user = storage.find_user_by_token(token)
+            user = user_cache.find_user_by_token(token)
             if user is None:
                 return 'Valid token is required', 403
 
@@ -57,7 +55,7 @@ def logged_in(func):
         if not token:
             return redirect(url_for('login'))
 
-        user = storage.find_user_by_token(session['logged_in'])
+        user = user_cache.find_user_by_token(session['logged_in'])
         if user is None:
             session.pop('logged_in', None)
             return redirect(url_for('login'))
@@ -67,41 +65,6 @@ def logged_in(func):
     return wrapper
 
 
-def send_json_rpc(cmd, args, hosts, timeout=0.5):
-    rv = {}
-    context = zmq.Context()
-
-    if isinstance(hosts, basestring):
-        hosts = [hosts]
-
-    for host in hosts:
-        rv[host] = None
-        try:
-            request = context.socket(zmq.DEALER)
-            request.connect('tcp://%s:5000' % host)
-            request.setsockopt(zmq.LINGER, 0)
-
-            #request.send_multipart([msgpack.packb(cmd), msgpack.packb(args)])
-            request.send(msgpack.packb([cmd, args]))
-
-            poller = zmq.Poller()
-            poller.register(request, zmq.POLLIN)
-            start = time()
-            while True:
-                socks = dict(poller.poll(timeout=timeout / 10.))
-                if request in socks and socks[request] == zmq.POLLIN:
-                    rv[host] = msgpack.unpackb(request.recv(zmq.POLLERR))
-                    break
-
-                if (time() - start) > timeout:
-                    break
-                sleep(timeout / 10.)
-        except zmq.ZMQError as err:
-            print str(err)
-            continue
-
-    return rv
-
 # JSON API
 
 def token_required_json(admin=False):
@@ -112,7 +75,7 @@ def token_required_json(admin=False):
             if not token:
                 return jsonify({"result" : "fail", "reason" : 'Access denied'})
 
-            user = storage.find_user_by_token(token)
+            user = user_cache.find_user_by_token(token)
             if user is None:
                 return jsonify({"result" : "ok", "reason" : 'Valid token is required'})
 
@@ -134,10 +97,39 @@ def logged_in_json(func):
         if not token:
             return jsonify({"result" : "fail"})
 
-        user = storage.find_user_by_token(session['logged_in'])
+        user = user_cache.find_user_by_token(session['logged_in'])
         if user is None:
             session.pop('logged_in', None)
             return jsonify({"result" : "Fail"})
 
         return func(user, *args, **kwargs)
     return wrapper
+
+
+# Lists
+
+def list_args():
+    """
+        Returns (offset, limit) of a list request, limit is None if not set
+    """
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = request.args.get('limit', None, type=int)
+    if limit is not None:
+        limit = max(limit, 0)
+    return offset, limit
+
+
+def paginate(items, offset=0, limit=None):
+    if limit is None:
+        return items[offset:]
+    return items[offset:offset + limit]
+
+
+def filter_summaries(summaries, name=None, type_=None, runlist=None):
+    """
+        Returns manifest summaries matching all of the given fields
+    """
+    filters = [(field, value) for field, value in (('name', name), ('type', type_), ('runlist', runlist))
+               if value is not None]
+    return dict((uuid, summary) for uuid, summary in summaries.iteritems()
+                if all(summary.get(field) == value for field, value in filters))
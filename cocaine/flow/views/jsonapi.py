@@ -1,28 +1,54 @@
 from flask import request, render_template, session, flash, redirect, url_for, current_app, json, jsonify
 
-from common import send_json_rpc, token_required, token_required_json, uniform, logged_in, logged_in_json
+from common import send_json_rpc, token_required, token_required_json, uniform, logged_in, logged_in_json, \
+    list_args, paginate, filter_summaries
 from storages.exceptions import UserExists
 from cocaine.flow.storages import storage
 
 # JSON API
 def get_apps():
+    """
+        Apps filtered by developer (username), name, type and runlist, sorted by uuid
+        and paginated by offset and limit. Returns uuids or summaries if view=summary,
+        X-Total-Count header is the number of filtered apps
+    """
+    developer = request.args.get('developer')
     try:
-        mm = storage.read_manifests()
-        return json.dumps([k for k in mm.iterkeys()])
+        if developer is not None:
+            user = storage.find_user_by_username(developer)
+            mm = storage.read_manifest_summaries(user['token']) if user is not None else {}
+        else:
+            mm = storage.read_manifest_summaries()
     except RuntimeError:
         return jsonify([])
 
+    mm = filter_summaries(mm, request.args.get('name'), request.args.get('type'), request.args.get('runlist'))
+    offset, limit = list_args()
+    page = paginate(sorted(mm), offset, limit)
+    if request.values.get('view') == 'summary':
+        page = [mm[uuid] for uuid in page]
+    return json.dumps(page), 200, {'X-Total-Count': str(len(mm))}
+
 def get_hosts():
     return json.dumps(storage.read_hosts())
 
 def get_runlists():
     try:
-        return json.dumps(storage.read(storage.key("system", "list:runlists")))
+        return json.dumps(storage.read_runlist_names())
     except RuntimeError:
         return json.dumps([])
 
 def get_runlists_apps():
-    return json.dumps(storage.read_runlists())
+    name = request.args.get('runlist')
+    if name is not None:
+        runlist = storage.read_runlist(name)
+        runlists = {name: runlist} if runlist is not None else {}
+    else:
+        runlists = storage.read_runlists()
+
+    offset, limit = list_args()
+    page = paginate(sorted(runlists), offset, limit)
+    return json.dumps(dict((name, runlists[name]) for name in page)), 200, {'X-Total-Count': str(len(runlists))}
 # 
 
 def auth():
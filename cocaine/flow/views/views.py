@@ -6,12 +6,24 @@ from yaml import YAMLError
 import hashlib
 import logging
 import os
+import tarfile
+from time import time
 from uuid import uuid4
-from flask import request, render_template, session, flash, redirect, url_for, current_app, json, jsonify
+from flask import request, render_template, session, flash, redirect, url_for, current_app, json, jsonify, \
+    Response, stream_with_context
 import sh
 import yaml
 from cocaine.flow.storages import storage
-from common import send_json_rpc, token_required, token_required_json, uniform, logged_in, logged_in_json
+from cocaine.flow.builds import builds
+from cocaine.flow.collector import collector
+from cocaine.flow.depcache import depends_cache
+from cocaine.flow.gitcache import git_cache, valid_ref, GitError
+from cocaine.flow.metrics import registry, build_step_latency
+from cocaine.flow.packer import pack, archive_format
+from cocaine.flow.rollout import Rollout, START_APP, STOP_APP
+from cocaine.flow.usercache import user_cache
+from common import send_json_rpc, iter_json_rpc, token_required, token_required_json, uniform, logged_in, logged_in_json, \
+    paginate, filter_summaries
 from .profile import PROFILE_OPTION_VALIDATORS
 from storages.exceptions import UserExists
 import admin
@@ -29,7 +41,10 @@ def home():
 def create_user(username, password, admin=False):
     token = str(uuid4())
     password = hashlib.sha1(password).hexdigest()
-    return storage.create_user(username, password, admin, token)
+    try:
+        return storage.create_user(username, password, admin, token)
+    finally:
+        user_cache.invalidate(token)
 
 
 def register():
@@ -82,28 +97,39 @@ def logout():
 def dashboard(user):
     grouped_manifests = {}
 
-    manifests = storage.read_manifests()
-    for uuid, manifest in manifests.items():
-        if not user['admin'] and user['token'] != manifest['developer']:
-            continue
-
+    # developers see their apps only, which are read from their own index
+    manifests = storage.read_manifest_summaries(None if user['admin'] else user['token'])
+    filters = dict((field, request.args[field]) for field in ('name', 'type', 'runlist') if field in request.args)
+    manifests = filter_summaries(manifests, filters.get('name'), filters.get('type'), filters.get('runlist'))
+
+    # pages are made of app names with all their versions
+    page_size = current_app.config.get('DASHBOARD_PAGE_SIZE', 50)
+    app_names = sorted(set(manifest['name'] for manifest in manifests.itervalues()))
+    pages = max((len(app_names) + page_size - 1) // page_size, 1)
+    page = min(max(request.args.get('page', 1, type=int), 1), pages)
+    page_names = set(paginate(app_names, (page - 1) * page_size, page_size))
+    manifests = dict((uuid, manifest) for uuid, manifest in manifests.iteritems() if manifest['name'] in page_names)
+
+    usernames = storage.get_usernames_by_tokens(set(manifest['developer'] for manifest in manifests.values()))
+    for uuid, manifest in sorted(manifests.items()):
+        # summaries may be shared through the storage cache
+        manifest = dict(manifest)
         #manifest['git_to_html_url'] = None 
         if manifest.get('url') is not None:
             try:
                 manifest['git_to_html_url'] = "http"+''.join(manifest['url'][3:]) 
             except Exception as err:
                 print str(err)
-        manifest['developer_username'] = storage.get_username_by_token(manifest['developer'])
+        manifest['developer_username'] = usernames.get(manifest['developer'])
         common_manifest_part = grouped_manifests.setdefault(manifest['name'], {})
         common_manifest_part.setdefault('description', manifest['description'])
         common_manifest_part.setdefault('type', manifest['type'])
         common_manifest_part.setdefault('manifests', []).append(manifest)
     runlists = storage.read_runlists()
-    print storage.read_hosts()
-    storage.delete_alias('test ')
+    hosts = storage.read_hosts()
     profiles = storage.read_profiles()
     PROFILE_OPTIONS = PROFILE_OPTION_VALIDATORS.keys()
-    return render_template('dashboard.html', hosts=storage.read_hosts(),  **locals())
+    return render_template('dashboard.html', **locals())
 
 
 @logged_in
@@ -134,24 +160,84 @@ def dashboard_edit(user):
 
     return value
 
+def read_stats(hosts):
+    """
+        Returns ({host: info}, {host: age in seconds}) for the given hosts
+        from the collector snapshot. Hosts the collector doesn't poll are
+        left out, the ones polled without an answer have None info and age.
+    """
+    now = time()
+    snapshot = collector.snapshot()
+    infos, ages = {}, {}
+    for host in hosts:
+        if host not in snapshot:
+            continue
+        info, updated = snapshot[host]
+        infos[host] = info
+        ages[host] = None if updated is None else int(now - updated)
+    return infos, ages
+
+
+def stream_template(template_name, **context):
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template(template_name)
+    return Response(stream_with_context(template.stream(context)))
+
+
 @logged_in
 def stats(user):
-    import itertools
-    hosts = storage.read_hosts()
+    hosts = collector.cluster_hosts()
     if not hosts:
-        return render_template('stats.html', user=user, hosts={})
-    hosts = send_json_rpc(2, [], set(itertools.chain(*hosts.values())))
-    return render_template('stats.html', user=user, hosts=hosts)
+        return render_template('stats.html', user=user, hosts=[], ages={})
+
+    if request.values.get('fresh'):
+        # render every host as soon as it answers
+        return stream_template('stats.html', user=user, hosts=iter_json_rpc(2, [], hosts), ages={})
+
+    infos, ages = read_stats(hosts)
+    hosts = sorted(((host, infos.get(host)) for host in hosts), key=lambda item: item[1])
+    return render_template('stats.html', user=user, hosts=hosts, ages=ages)
+
+
+@token_required
+def stats_stream(user):
+    """
+        Newline delimited json: one {"host": ..., "info": ...} record per
+        answered host as it arrives, then {"timeout": [hosts]}.
+    """
+    hosts = collector.cluster_hosts()
+
+    def generate():
+        timeout = []
+        for host, info in iter_json_rpc(2, [], hosts):
+            if info is None:
+                timeout.append(host)
+                continue
+            yield json.dumps({'host': host, 'info': info}) + '\n'
+        yield json.dumps({'timeout': timeout}) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
 
 @token_required
 def host_stats(alias, host, user):
-    result_info =  send_json_rpc(2, [], set([host,]))
+    result_info = {}
+    if not request.values.get('fresh'):
+        result_info, ages = read_stats([host])
+    if host not in result_info:
+        # asked for fresh stats or the host isn't polled by collector yet,
+        # a polled host which didn't answer isn't asked again
+        result_info = send_json_rpc(2, [], [host])
     res = result_info.get(host)
     if res is not None:
         return jsonify(res)
     else:
         return 'None'
 
+
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
 def process_json_rpc_response(res, uuid):
     for host, rv in res.items():
         answer = rv[uuid]
@@ -182,10 +268,44 @@ def get_profiles():
 
 
 def exists(prefix, postfix):
-    try:
-        return str(storage.read(storage.key(prefix, postfix)))
-    except:
-        return 'Not exists', 404
+    if storage.exists(storage.key(prefix, postfix)):
+        return 'Exists'
+    return 'Not exists', 404
+
+
+def download_app(uuid):
+    """
+        Streams app archive. Archive sha1 is its ETag, a single byte range
+        is served partially, so interrupted downloads can be resumed
+    """
+    info = storage.stat_app(uuid)
+    if info is None:
+        return 'App %s doesn\'t exist' % uuid, 404
+
+    etag, size = info['hash'], info['size']
+    headers = {'Accept-Ranges': 'bytes'}
+    if etag is not None:
+        headers['ETag'] = '"%s"' % etag
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers=headers)
+
+    offset, length, status = 0, size, 200
+    range_ = request.range
+    # If-Range with a date is never satisfied as archives have no modification time
+    if range_ is not None and len(range_.ranges) == 1 and \
+            ('If-Range' not in request.headers or etag is not None and request.if_range.etag == etag):
+        bounds = range_.range_for_length(size)
+        if bounds is None:
+            headers['Content-Range'] = 'bytes */%d' % size
+            return Response(status=416, headers=headers)
+        start, stop = bounds
+        offset, length, status = start, stop - start, 206
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+
+    headers['Content-Length'] = str(length)
+    headers['Content-Disposition'] = 'attachment; filename=%s' % uuid
+    return Response(stream_with_context(storage.iter_app(uuid, offset, length, info['blob'])), status, headers=headers,
+                    mimetype='application/octet-stream', direct_passthrough=True)
 
 
 def validate_info(info):
@@ -202,12 +322,11 @@ def validate_info(info):
         raise KeyError('App description is required in info file')
 
 
-def upload_app(app, info, ref, token):
+def upload_app(app, info, ref, token, app_name=None):
     logger.debug('Uploading application')
 
     validate_info(info)
 
-    app_name = request.values.get('name')
     if app_name:
         info['uuid'] = app_name.strip()
     else:
@@ -235,16 +354,29 @@ def upload_app(app, info, ref, token):
 def download_depends(depends, type_, path):
     logger.debug('Downloading dependencies for %s', path)
     if type_ == 'python':
+        if not depends:
+            # pip refuses to install nothing
+            return []
         install_path = "%s/depends" % path
+    elif type_ == 'nodejs':
+        install_path = "%s/node_modules" % path
+    else:
+        return []
+
+    cache_key = depends_cache.key(type_, depends, path)
+    if depends_cache.restore(cache_key, install_path):
+        return os.listdir(install_path)
+
+    if type_ == 'python':
         #        pip install -b /tmp  --src=/tmp --install-option="--install-lib=/home/inkvi/test" -v msgpack-python
         output = sh.pip("install", "-v", "-I", "-b", path, "--src", path, "--install-option",
                         "--install-lib=%s" % install_path, *depends)
-        return os.listdir(install_path)
     elif type_ == 'nodejs':
-        install_path = "%s/node_modules"%path 
         sh.mkdir("-p",install_path)
         sh.npm("install","--production",_cwd=path)
-        return os.listdir(install_path)
+
+    depends_cache.store(cache_key, install_path)
+    return os.listdir(install_path)
 
 
 def upload_repo(token):
@@ -256,7 +388,6 @@ def upload_repo(token):
 
     user = s.find_user_by_token(token)
     logger.error("user %s uploading repo",user["username"])
-    username = user["username"]
 
     if not url:
         return 'Empty url', 400
@@ -270,81 +401,103 @@ def upload_repo(token):
     if type_ not in ['git', 'cvs', 'hg']:
         return 'Invalid cvs type', 400
 
-    if "UPLOAD_FOLDER" in current_app.config:
-        base_clone_path = current_app.config["UPLOAD_FOLDER"]
-    else:
-        base_clone_path = "/tmp"
-    clone_path = "%s/%s" % (base_clone_path,os.path.basename(url))
-    if os.path.exists(clone_path):
-        sh.rm("-rf", clone_path)
+    if type_ != 'git':
+        return "Application was failed to upload", 400
 
-    if type_ == 'git':
-        ref = ref or "HEAD"
-        sh.git("clone", url, clone_path)
+    if ref and not valid_ref(ref):
+        return 'Invalid reference %s' % ref, 400
 
-        try:
-            ref = sh.git("rev-parse", ref, _cwd=clone_path).strip()
-        except sh.ErrorReturnCode as e:
-            return 'Invalid reference. %s' % e, 400
+    job_id = builds.submit(build_repo, url, ref, token, request.values.get('name'), token=token)
+    return 'Build %s is queued' % job_id
 
-        if not os.path.exists(clone_path + "/info.yaml"):
-            return 'info.yaml is required', 400
 
-        try:
-            package_info = yaml.load(file(clone_path + '/info.yaml'))
-            validate_info(package_info)
-        except YAMLError:
-            return 'Bad encoded info.yaml', 400
-        except (ValueError, KeyError) as e:
-            return str(e), 400
+def build_repo(job_id, url, ref, token, app_name=None):
+    """
+        Builds and uploads application from git repository. Runs in build queue,
+        every job gets its own workspace under UPLOAD_FOLDER.
+    """
+    base_clone_path = current_app.config.get("UPLOAD_FOLDER", "/tmp")
+    workspace = "%s/%s" % (base_clone_path, job_id)
+    clone_path = "%s/%s" % (workspace, os.path.basename(url))
+    sh.mkdir("-p", workspace)
+    try:
+        return build_git_repo(clone_path, url, ref, token, app_name)
+    finally:
+        sh.rm("-rf", workspace)
 
-        try:
-            depends_path = download_depends(package_info['depends'], package_info['type'], clone_path)
-        except sh.ErrorReturnCode as e:
-            return 'Unable to install dependencies. %s' % e, 503
 
-        # remove info.yaml from tar.gz
-        with open(clone_path + '/.gitattributes', 'w') as f:
-            f.write('info.yaml export-ignore')
+def build_git_repo(clone_path, url, ref, token, app_name=None):
+    ref = ref or "HEAD"
+    try:
+        with build_step_latency.time(step='fetch'):
+            mirror, ref = git_cache.fetch(url, ref)
+    except (sh.ErrorReturnCode, GitError) as e:
+        return 'Invalid reference. %s' % e, 400
+
+    with build_step_latency.time(step='checkout'):
+        git_cache.checkout(mirror, ref, clone_path)
 
-        try:
-            logger.debug("Packing application to tar.gz")
-            sh.git("archive", ref, "--worktree-attributes", format="tar", o="app.tar", _cwd=clone_path),
-            if package_info["type"] == "nodejs":
-                sh.tar("-uf", "app.tar", "node_modules", _cwd=clone_path)
-            elif package_info["type"] == "python":
-                sh.tar("-uf", "app.tar", "-C", clone_path + "/depends", *depends_path, _cwd=clone_path)
-            sh.gzip("app.tar", _cwd=clone_path)
-            package_files = sh.tar('-tf', 'app.tar.gz', _cwd=clone_path)
-            package_info['structure'] = [f.strip() for f in package_files]
-        except sh.ErrorReturnCode as e:
-            return 'Unable to pack application. %s' % e, 503
+    if not os.path.exists(clone_path + "/info.yaml"):
+        return 'info.yaml is required', 400
 
-        try:
-            for line in sh.git("log", "-5", date="short", format="%h %ad %s [%an]", _cwd=clone_path):
-                line = line.strip()
+    try:
+        package_info = yaml.load(file(clone_path + '/info.yaml'))
+        validate_info(package_info)
+    except YAMLError:
+        return 'Bad encoded info.yaml', 400
+    except (ValueError, KeyError) as e:
+        return str(e), 400
 
-                # git log output is using ansi terminal codes which is messy for our purposes
-                ansisequence = re.compile(r'\x1B\[[^A-Za-z]*[A-Za-z]')
-                line = ansisequence.sub('', line)
-                line = line.strip("\x1b=\r")
-                line = line.strip("\x1b>")
-                if not line:
-                    continue
-                package_info.setdefault('changelog', []).append(line)
-        except sh.ErrorReturnCode as e:
-            return 'Unable to pack application. %s' % e, 503
+    try:
+        with build_step_latency.time(step='depends'):
+            depends_path = download_depends(package_info.get('depends') or [], package_info['type'], clone_path)
+    except sh.ErrorReturnCode as e:
+        return 'Unable to install dependencies. %s' % e, 503
 
+    if package_info["type"] == "nodejs":
+        depends = [(clone_path + "/node_modules", "node_modules")]
+    else:
+        depends = [(clone_path + "/depends/" + name, name) for name in depends_path]
 
-        try:
-            with open(clone_path + "/app.tar.gz") as app:
-                package_info['url'] = url
-                uuid = upload_app(app, package_info, ref, token)
-            return "Application %s was successfully uploaded" % uuid
-        except (KeyError, ValueError) as e:
-            return str(e), 400
+    config = current_app.config
+    codec = config.get('PACKAGE_CODEC', 'gzip')
+    try:
+        package_path = "%s/app.%s" % (clone_path, archive_format(codec))
+        logger.debug("Packing application to %s", package_path)
+        with build_step_latency.time(step='pack'), open(package_path, "wb") as app:
+            with git_cache.archive(mirror, ref) as tree:
+                package_info.update(pack(app, tree, depends, codec,
+                                         config.get('PACKAGE_COMPRESSION_LEVEL'),
+                                         config.get('PACKAGE_COMPRESSION_WORKERS')))
+    except (GitError, tarfile.TarError, IOError, ValueError) as e:
+        return 'Unable to pack application. %s' % e, 503
+
+    try:
+        with build_step_latency.time(step='changelog'):
+            changelog = list(git_cache.changelog(mirror, ref))
+        for line in changelog:
+            line = line.strip()
+
+            # git log output is using ansi terminal codes which is messy for our purposes
+            ansisequence = re.compile(r'\x1B\[[^A-Za-z]*[A-Za-z]')
+            line = ansisequence.sub('', line)
+            line = line.strip("\x1b=\r")
+            line = line.strip("\x1b>")
+            if not line:
+                continue
+            package_info.setdefault('changelog', []).append(line)
+    except sh.ErrorReturnCode as e:
+        return 'Unable to pack application. %s' % e, 503
+
+
+    try:
+        with build_step_latency.time(step='upload'), open(package_path) as app:
+            package_info['url'] = url
+            uuid = upload_app(app, package_info, ref, token, app_name)
+        return "Application %s was successfully uploaded" % uuid
+    except (KeyError, ValueError) as e:
+        return str(e), 400
 
-    return "Application was failed to upload", 400
 
 @uniform
 @token_required
@@ -370,13 +523,37 @@ def upload(user):
         return 'Bad encoded json', 400
 
     try:
-        uuid = upload_app(app, package_info, ref, user['token'])
+        uuid = upload_app(app, package_info, ref, user['token'], request.values.get('name'))
     except (KeyError, ValueError) as e:
         return str(e), 400
 
     return 'Application %s was successfully uploaded' % uuid
 
 
+@token_required
+def upload_status(job_id, user):
+    job = builds.get(job_id)
+    # builds of other users are hidden from them
+    if job is None or not user.get('admin', False) and job.get('token') != user['token']:
+        return 'Build %s doesn\'t exist' % job_id, 404
+    job.pop('_id', None)
+    job.pop('token', None)
+    return jsonify(job)
+
+
+def create_rollout():
+    """
+        Rollout settings come from DEPLOY_* config options and
+        can be overridden by query args of deploy request
+    """
+    config = current_app.config
+    args = request.args
+    return Rollout(batch_size=args.get('batch_size', config.get('DEPLOY_BATCH_SIZE'), type=int),
+                   max_inflight=args.get('max_inflight', config.get('DEPLOY_MAX_INFLIGHT'), type=int),
+                   success_threshold=args.get('success_threshold', config.get('DEPLOY_SUCCESS_THRESHOLD', 1.0),
+                                              type=float))
+
+
 @token_required(admin=True)
 def deploy(runlist, uuid, profile, user):
     import itertools
@@ -403,13 +580,8 @@ def deploy(runlist, uuid, profile, user):
         if s.read_profile(profile) is None:
             return 'Profile name is not valid', 400
 
-    # update runlists
-    if is_undeploy:
-        if uuid not in runlist_dict:
-            return '%s app is not deployed' % uuid, 400
-        del runlist_dict[uuid]
-    else:
-        runlist_dict[uuid] = profile
+    if is_undeploy and uuid not in runlist_dict:
+        return '%s app is not deployed' % uuid, 400
 
     #manifest update
     if is_undeploy:
@@ -417,26 +589,37 @@ def deploy(runlist, uuid, profile, user):
     else:
         manifest['runlist'] = runlist
 
-    print hosts
+    start = (START_APP, [{uuid: profile}])
+    stop = (STOP_APP, [[uuid]])
+    cmd, args = stop if is_undeploy else start
+    undo = start if is_undeploy else stop
+
+    success, res = create_rollout().run(cmd, args, itertools.chain(*hosts.values()), undo)
+    logger.debug("Rollout result: %s" % res)
+    if not success:
+        return json.dumps({'result': 'fail', 'hosts': res}), 500
+
     if is_undeploy:
-        res = send_json_rpc(1, [[uuid]], itertools.chain(*hosts.values()))
+        s.runlist_remove(runlist, uuid)
     else:
-        res = send_json_rpc(0, [{uuid: profile}], itertools.chain(*hosts.values()))
-
-    logger.debug("JSON RPC Response: %s" % res)
-    for host, host_res in res.items():
-        if not host_res:
-            return 'Cocaine RPC on %s didn\'t process call' % host, 500
-        for app_uuid, res in host_res.items():
-            if 'error' in res:
-                return "%s - %s" % (app_uuid, res['error']), 500
-            logger.debug("Deploy: %s. %s", app_uuid, res)
-
-    s.write_runlist(runlist, runlist_dict)
+        s.runlist_add(runlist, uuid, profile)
     s.write_manifest(uuid, manifest)
 
+    if request.args.get('report'):
+        return json.dumps({'result': 'ok', 'hosts': res})
     return 'ok'
 
+@token_required
+def get_manifest(uuid, user):
+    manifest = storage.read_manifest(uuid)
+    if manifest is None:
+        return 'Manifest for app %s doesn\'t exist' % uuid, 404
+    if not user['admin'] and manifest['developer'] != user['token']:
+        return 'Access denied', 403
+    manifest.pop('_id', None)
+    return jsonify(manifest)
+
+
 @token_required(admin=False)
 def delete_app(app_name, user=None):
     s = storage
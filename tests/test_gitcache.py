@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import sh
+from cocaine.flow.gitcache import GitMirrorCache, GitError, valid_ref
+
+
+class RefTest(unittest.TestCase):
+    def test_names_and_shas(self):
+        for ref in ('HEAD', 'master', 'release/1.0', 'v1.0', 'a3537fa', 'a3537fa7c1edb975f02d50ad6fcefb688d9a3746'):
+            self.assertTrue(valid_ref(ref), ref)
+
+    def test_options_and_bad_names(self):
+        for ref in ('', '-x', '--upload-pack=touch pwned', 'a..b', 'x y', 'x~1'):
+            self.assertFalse(valid_ref(ref), ref)
+
+    def test_fetch_refuses_options(self):
+        path = tempfile.mkdtemp()
+        try:
+            marker = os.path.join(path, 'pwned')
+            repo = os.path.join(path, 'repo')
+            sh.git("init", "-q", repo)
+            with self.assertRaises(GitError):
+                GitMirrorCache(os.path.join(path, 'cache')).fetch(
+                    repo, '--upload-pack=touch %s; git-upload-pack' % marker)
+            self.assertFalse(os.path.exists(marker))
+        finally:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import sys
+import unittest
+from time import sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+from cocaine.flow import rpc
+import fakenode
+
+
+PORT = 15900
+
+
+class DropEveryOtherHost(fakenode.FakeHost):
+    """
+        Leaves every odd request unanswered
+    """
+
+    @property
+    def drop_rate(self):
+        return 1.0 if self.requests % 2 else 0.0
+
+    @drop_rate.setter
+    def drop_rate(self, value):
+        pass
+
+
+def run_node(ready, stop):
+    host = DropEveryOtherHost(PORT)
+    ready.set()
+    fakenode.serve([host], stop=stop)
+
+
+class LostRequestsTest(unittest.TestCase):
+    def setUp(self):
+        ready = multiprocessing.Event()
+        self.stop = multiprocessing.Event()
+        self.node = multiprocessing.Process(target=run_node, args=(ready, self.stop))
+        self.node.start()
+        ready.wait()
+        sleep(0.2)
+
+    def tearDown(self):
+        rpc.pool.close()
+        self.stop.set()
+        self.node.join()
+
+    def test_lost_request_does_not_shift_replies(self):
+        host = '127.0.0.1:%d' % PORT
+        for number in xrange(1, 11):
+            reply = rpc.send_json_rpc(fakenode.INFO, [], [host], 0.2)[host]
+            if number % 2:
+                self.assertIsNone(reply)
+            else:
+                # the reply is to this very request, not to a lost earlier one
+                self.assertEqual(reply['requests'], number)
+
+
+class EndpointTest(unittest.TestCase):
+    def test_names_and_ipv4(self):
+        self.assertEqual(rpc.endpoint('node', 5000), ('tcp://node:5000', False))
+        self.assertEqual(rpc.endpoint('10.0.0.1:6000', 5000), ('tcp://10.0.0.1:6000', False))
+
+    def test_ipv6(self):
+        self.assertEqual(rpc.endpoint('fe80::1', 5000), ('tcp://[fe80::1]:5000', True))
+        self.assertEqual(rpc.endpoint('[::1]', 5000), ('tcp://[::1]:5000', True))
+        self.assertEqual(rpc.endpoint('[::1]:6000', 5000), ('tcp://[::1]:6000', True))
+
+
+if __name__ == '__main__':
+    unittest.main()
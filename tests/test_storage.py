@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cocaine', 'flow'))
+
+import msgpack
+from cocaine.flow.storages.cache import ReadCache
+from cocaine.flow.storages.memory import Memory, MemorySession
+
+CHUNK_SIZE = 1024
+ARCHIVE = ''.join(chr(i % 251) for i in xrange(100 * CHUNK_SIZE + 17))
+
+
+class CountingFile(object):
+    def __init__(self, data):
+        self.file = StringIO(data)
+        self.largest_read = 0
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.largest_read = max(self.largest_read, len(data))
+        return data
+
+    def seek(self, offset, whence=0):
+        self.file.seek(offset, whence)
+
+
+class CountingSession(MemorySession):
+    def __init__(self):
+        super(CountingSession, self).__init__()
+        self.largest_write = 0
+        self.written = 0
+
+    def write_data(self, key, data, offset=0, *args, **kwargs):
+        self.largest_write = max(self.largest_write, len(data))
+        self.written += len(data)
+        return super(CountingSession, self).write_data(key, data, offset, *args, **kwargs)
+
+    def write(self, key, data, *args, **kwargs):
+        self.largest_write = max(self.largest_write, len(data))
+        self.written += len(data)
+        return super(CountingSession, self).write(key, data, *args, **kwargs)
+
+
+class NodeArchivesTest(unittest.TestCase):
+    """
+        Elliptics default: archives are kept in `apps\\0<uuid>` for nodes
+    """
+
+    def setUp(self):
+        self.session = CountingSession()
+        self.storage = Memory(CHUNK_SIZE, self.session, node_archives=True)
+
+    def test_archive_is_streamed_by_chunks(self):
+        data = CountingFile(ARCHIVE)
+        self.storage.save_app('app', data)
+
+        self.assertLessEqual(data.largest_read, CHUNK_SIZE)
+        self.assertLessEqual(self.session.largest_write, CHUNK_SIZE)
+        # nodes read the archive as a single msgpack value, there is no other copy
+        self.assertEqual(msgpack.unpackb(self.session.data['apps\0app']), ARCHIVE)
+        self.assertFalse([key for key in self.session.data if key.startswith('blob')])
+        self.assertLess(self.session.written, len(ARCHIVE) + CHUNK_SIZE)
+
+    def test_download(self):
+        self.storage.save_app('app', StringIO(ARCHIVE))
+        self.assertEqual(''.join(self.storage.iter_app('app')), ARCHIVE)
+        self.assertEqual(''.join(self.storage.iter_app('app', 1000, 5000)), ARCHIVE[1000:6000])
+        info = self.storage.stat_app('app')
+        self.assertEqual(info['size'], len(ARCHIVE))
+        self.assertEqual(''.join(self.storage.iter_app('app', 0, None, info['blob'])), ARCHIVE)
+
+    def test_duplicate_upload_writes_nothing(self):
+        self.storage.save_app('app', StringIO(ARCHIVE))
+        written = self.session.written
+        self.storage.save_app('app', StringIO(ARCHIVE))
+        self.assertEqual(self.session.written, written)
+        self.assertEqual(''.join(self.storage.iter_app('app')), ARCHIVE)
+
+    def test_shorter_upload_replaces_archive(self):
+        self.storage.save_app('app', StringIO(ARCHIVE))
+        self.storage.save_app('app', StringIO('short'))
+        self.assertEqual(msgpack.unpackb(self.session.data['apps\0app']), 'short')
+
+
+class StaleCacheTest(unittest.TestCase):
+    """
+        Lists are modified from values in storage, not from the read cache
+        of the process, which doesn't see changes of other processes
+    """
+
+    def setUp(self):
+        session = MemorySession()
+        self.cached = Memory(CHUNK_SIZE, session)
+        self.cached.set_cache(ReadCache(100, 3600))
+        self.other = Memory(CHUNK_SIZE, session)
+
+    def test_list_add(self):
+        self.cached.list_add('system', 'list:x', 'a')
+        self.assertEqual(self.cached.read('system\0list:x'), ['a'])
+        self.other.list_add('system', 'list:x', 'b')
+        self.cached.list_add('system', 'list:x', 'c')
+        self.assertEqual(sorted(self.other.read('system\0list:x')), ['a', 'b', 'c'])
+
+    def test_add_host(self):
+        self.cached.add_host('alias', 'h1')
+        self.assertEqual(self.cached.read_hosts(), {'alias': ['h1']})
+        self.other.add_host('alias', 'h2')
+        self.cached.add_host('alias', 'h3')
+        self.assertEqual(self.other.read_hosts(), {'alias': ['h1', 'h2', 'h3']})
+
+    def test_runlist_add(self):
+        self.cached.runlist_add('r', 'a', 'default')
+        self.assertEqual(self.cached.read_runlist('r'), {'a': 'default'})
+        self.other.runlist_add('r', 'b', 'default')
+        self.cached.runlist_add('r', 'c', 'default')
+        self.assertEqual(self.other.read_runlist('r'), {'a': 'default', 'b': 'default', 'c': 'default'})
+
+    def test_summaries(self):
+        self.cached.write_manifest('a', {'uuid': 'a', 'developer': 'dev'})
+        self.assertEqual(list(self.cached.read_manifest_summaries('dev')), ['a'])
+        self.other.write_manifest('b', {'uuid': 'b', 'developer': 'dev'})
+        self.cached.write_manifest('c', {'uuid': 'c', 'developer': 'dev'})
+        self.assertEqual(sorted(self.other.read_manifest_summaries()), ['a', 'b', 'c'])
+        self.assertEqual(sorted(self.other.read_manifest_summaries('dev')), ['a', 'b', 'c'])
+
+
+class BuildsTest(unittest.TestCase):
+    def test_job_is_listed_once(self):
+        storage = Memory(CHUNK_SIZE)
+        storage.create_build('job', {'status': 'queued', 'created': 1})
+        list_key = 'system\0list:builds'
+        listed = storage.storage.data[list_key]
+        for status in ('running', 'done'):
+            storage.write_build('job', {'status': status, 'created': 1})
+        self.assertIs(storage.storage.data[list_key], listed)
+        self.assertEqual(storage.read(list_key), ['job'])
+        self.assertEqual(storage.read_build('job')['status'], 'done')
+
+        storage.clean_builds(2)
+        self.assertIsNone(storage.read_build('job'))
+        self.assertEqual(storage.read(list_key), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
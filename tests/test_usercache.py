@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cocaine', 'flow'))
+
+from flask import Flask
+from cocaine.flow.storages.memory import Memory
+from cocaine.flow.usercache import UserCache
+
+
+class CountingMemory(Memory):
+    def __init__(self):
+        super(CountingMemory, self).__init__()
+        self.lookups = 0
+
+    def find_user_by_token(self, token):
+        self.lookups += 1
+        return super(CountingMemory, self).find_user_by_token(token)
+
+
+class UserCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.storage = CountingMemory()
+        self.app.storage.create_user('bob', 'password', False, 'token')
+        self.context = self.app.app_context()
+        self.context.push()
+        self.cache = UserCache()
+
+    def tearDown(self):
+        self.context.pop()
+
+    def test_known_token_is_cached(self):
+        user = self.cache.find_user_by_token('token')
+        self.assertEqual(user['token'], 'token')
+        user['admin'] = True
+        self.assertFalse(self.cache.find_user_by_token('token')['admin'])
+        self.assertEqual(self.app.storage.lookups, 1)
+
+    def test_unknown_token_is_cached_separately(self):
+        self.assertIsNone(self.cache.find_user_by_token('random'))
+        self.assertIsNone(self.cache.find_user_by_token('random'))
+        self.assertEqual(self.app.storage.lookups, 1)
+        self.assertEqual(len(self.cache.users.entries), 0)
+
+    def test_invalidate(self):
+        self.assertIsNone(self.cache.find_user_by_token('new'))
+        self.app.storage.create_user('alice', 'password', False, 'new')
+        self.cache.invalidate('new')
+        self.assertEqual(self.cache.find_user_by_token('new')['token'], 'new')
+
+    def test_disabled(self):
+        self.cache.configure(0, 0, 0, 0)
+        self.cache.find_user_by_token('token')
+        self.cache.find_user_by_token('random')
+        self.cache.find_user_by_token('token')
+        self.cache.find_user_by_token('random')
+        self.assertEqual(self.app.storage.lookups, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()